@@ -0,0 +1,323 @@
+"""
+End-to-end benchmarks of the chatbot, code reviewer, summarizer and embedding pipeline against the local mock backend
+(common/mock_openai.py), so they run without the OpenAI API and give comparable numbers from run to run.
+
+Run it from the repository root:
+
+    python -m benchmarks.run [--tools chatbot reviewer] [--error-rate 0.05] [--compare benchmarks/results/<file>]
+
+Each tool gets its own mock, so the request and token counts come from the mock's usage accounting. Time to first
+token is measured on the client for every streamed completion. Results are written to benchmarks/results/, named
+after the current commit, so runs on different commits can be compared with --compare.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import openai
+
+from common.client import configure
+from common.mock_openai import WORDS, MockConfig, MockUsage, start_in_thread
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+@dataclass
+class ToolResult:
+    wall_time: float
+    requests: int
+    requests_per_second: float
+    prompt_tokens: int
+    completion_tokens: int
+    tokens_per_second: float
+    injected_errors: int
+    failures: int
+    ttft_p50_ms: Optional[float] = None
+    ttft_p99_ms: Optional[float] = None
+    details: Dict = field(default_factory=dict)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class FirstTokenTimer:
+    """
+    Records the time from starting a streamed completion to its first chunk, for both ChatCompletion.create and
+    ChatCompletion.acreate, while installed.
+    """
+
+    def __init__(self):
+        self.times: List[float] = []
+
+    @contextlib.contextmanager
+    def installed(self):
+        create, acreate = openai.ChatCompletion.create, openai.ChatCompletion.acreate
+        timer = self
+
+        def timed_create(*args, **kwargs):
+            start = time.perf_counter()
+            response = create(*args, **kwargs)
+            if not kwargs.get("stream"):
+                return response
+
+            def chunks():
+                for i, chunk in enumerate(response):
+                    if i == 0:
+                        timer.times.append(time.perf_counter() - start)
+                    yield chunk
+            return chunks()
+
+        async def timed_acreate(*args, **kwargs):
+            start = time.perf_counter()
+            response = await acreate(*args, **kwargs)
+            if not kwargs.get("stream"):
+                return response
+
+            async def chunks():
+                first = True
+                async for chunk in response:
+                    if first:
+                        timer.times.append(time.perf_counter() - start)
+                        first = False
+                    yield chunk
+            return chunks()
+
+        openai.ChatCompletion.create, openai.ChatCompletion.acreate = timed_create, timed_acreate
+        try:
+            yield self
+        finally:
+            openai.ChatCompletion.create, openai.ChatCompletion.acreate = create, acreate
+
+
+def measure(run: Callable[[], Dict], config: MockConfig) -> ToolResult:
+    """
+    Point the client at a fresh mock, run one tool benchmark with its output silenced, and summarize what the mock
+    served.
+    """
+    api_base, app = start_in_thread(config)
+    openai.api_base, openai.api_key = api_base, "mock"
+    # The mock has no quota, so only cap the request rate, and start every tool with fresh limiters.
+    for model in ("gpt-3.5-turbo", "text-embedding-ada-002"):
+        configure(model, requests_per_minute=60_000)
+    timer = FirstTokenTimer()
+    start = time.perf_counter()
+    with timer.installed(), contextlib.redirect_stdout(io.StringIO()):
+        details = run()
+    wall_time = time.perf_counter() - start
+
+    usage: MockUsage = app["usage"]
+    ttfts = timer.times
+    return ToolResult(
+        wall_time=round(wall_time, 3),
+        requests=usage.requests,
+        requests_per_second=round(usage.requests / wall_time, 2),
+        prompt_tokens=usage.prompt_tokens,
+        completion_tokens=usage.completion_tokens,
+        tokens_per_second=round((usage.prompt_tokens + usage.completion_tokens) / wall_time, 1),
+        injected_errors=usage.rate_limit_errors + usage.connection_errors,
+        failures=details.pop("failures", 0),
+        ttft_p50_ms=round(statistics.median(ttfts) * 1000, 1) if ttfts else None,
+        ttft_p99_ms=round(percentile(ttfts, 0.99) * 1000, 1) if ttfts else None,
+        details=details,
+    )
+
+
+def synthetic_prose(words: int, seed: int) -> str:
+    rng = random.Random(seed)
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(8, 25))
+        sentences.append(" ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + ".")
+        words -= length
+    paragraphs = [" ".join(sentences[i:i + 5]) for i in range(0, len(sentences), 5)]
+    return "\n\n".join(paragraphs)
+
+
+def use_tool(directory: str) -> None:
+    # The tools are scripts that import their sibling modules, so their directory has to be importable.
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def bench_chatbot(args) -> ToolResult:
+    use_tool("chatbot")
+    import chatbot
+
+    async def conversation(index: int) -> int:
+        messages = [{"role": "system", "content": "You are a helpful assistant."}]
+        failures = 0
+        for turn in range(args.chat_messages):
+            messages.append({"role": "user", "content": f"Message {turn} from user {index}"})
+            try:
+                reply = "".join([content async for content in chatbot.stream_chat(messages, chatbot.StreamStats())])
+            except openai.OpenAIError:
+                failures += 1
+                continue
+            messages.append({"role": "assistant", "content": reply})
+        return failures
+
+    async def run_all() -> Dict:
+        failures = await asyncio.gather(*(conversation(i) for i in range(args.chat_sessions)))
+        return {"sessions": args.chat_sessions, "messages_per_session": args.chat_messages, "failures": sum(failures)}
+
+    return measure(lambda: asyncio.run(run_all()), MockConfig(error_rate=args.error_rate))
+
+
+REVIEW_REPLY = """<root>
+<patch><![CDATA[
+@@ -1,2 +1,2 @@
+-import os
++import os.path
+ import sys
+]]></patch>
+<explanation>Only os.path is used, so import it directly.</explanation>
+</root>"""
+
+
+def bench_reviewer(args) -> ToolResult:
+    use_tool("code_reviewer")
+    import reviewer
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def run() -> Dict:
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for i in range(args.review_files):
+                path = os.path.join(directory, f"module_{i}.py")
+                with open(path, "w") as f:
+                    f.write("import os\nimport sys\n\n\n" + "".join(
+                        f"def function_{j}(path):\n    return os.path.join(path, '{j}')\n\n\n" for j in range(5)))
+                files.append(path)
+            reviews = reviewer.review_files(files, "gpt-3.5-turbo", args.review_workers)
+        return {"files": len(files), "failures": sum(1 for review in reviews if review.error)}
+
+    return measure(run, MockConfig(reply_text=REVIEW_REPLY, tokens_per_second=200.0, error_rate=args.error_rate))
+
+
+def bench_summarizer(args) -> ToolResult:
+    use_tool("summarizer")
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    text = synthetic_prose(args.summary_words, seed=0)
+
+    def run() -> Dict:
+        # Summaries are memoized to cache.sqlite3 in the working directory; start from an empty one.
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                import summarize
+                summarize.summarize_for_targets(text, [500], 4097, ("\n\n", ".", " "), "gpt-3.5-turbo")
+            finally:
+                os.chdir(cwd)
+        return {"words": args.summary_words}
+
+    return measure(run, MockConfig(reply_tokens=200, tokens_per_second=200.0, error_rate=args.error_rate))
+
+
+def bench_embeddings(args) -> ToolResult:
+    from embeddings.pipeline import EmbeddingError, embed_strings
+
+    rng = random.Random(0)
+    texts = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(50, 600))) + f" ({i})"
+             for i in range(args.embedding_texts)]
+
+    def run() -> Dict:
+        try:
+            embed_strings(texts, workers=4)
+        except EmbeddingError as e:
+            return {"texts": len(texts), "failures": len(e.failed)}
+        return {"texts": len(texts)}
+
+    return measure(run, MockConfig(error_rate=args.error_rate))
+
+
+TOOLS = {
+    "chatbot": bench_chatbot,
+    "reviewer": bench_reviewer,
+    "summarizer": bench_summarizer,
+    "embeddings": bench_embeddings,
+}
+
+
+def git_revision() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def compare(results: Dict, baseline_file: str) -> None:
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline['revision']} ({baseline_file}):")
+    for tool, result in results["tools"].items():
+        previous = baseline["tools"].get(tool)
+        if previous is None:
+            continue
+        for metric in ("wall_time", "requests_per_second", "tokens_per_second", "ttft_p50_ms", "ttft_p99_ms"):
+            old, new = previous.get(metric), result.get(metric)
+            if old and new is not None:
+                print(f"  {tool:<11} {metric:<20} {old:>10} -> {new:>10} ({(new - old) / old:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tools against the local mock backend")
+    parser.add_argument("--tools", nargs="+", choices=list(TOOLS), default=list(TOOLS))
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests the mock fails with a rate limit or connection error")
+    parser.add_argument("--chat-sessions", type=int, default=20)
+    parser.add_argument("--chat-messages", type=int, default=3)
+    parser.add_argument("--review-files", type=int, default=40)
+    parser.add_argument("--review-workers", type=int, default=8)
+    parser.add_argument("--summary-words", type=int, default=30_000)
+    parser.add_argument("--embedding-texts", type=int, default=2000)
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    results = {
+        "revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "error_rate": args.error_rate,
+        "tools": {},
+    }
+    for tool in args.tools:
+        print(f"Benchmarking {tool}...", file=sys.stderr)
+        results["tools"][tool] = asdict(TOOLS[tool](args))
+    print(json.dumps(results, indent=2))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{revision}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved the results to {output}", file=sys.stderr)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,185 @@
+import asyncio
+import io
 import openai
 import os
+import signal
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator
 from dotenv import load_dotenv
 from termcolor import colored
 
+# Make the shared modules in <repository_home>/common importable when running from this directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from context import ConversationContext
+from common.client import acall_with_retries, estimate_chat_tokens, limiter_for
+from common.tokens import count_tokens, num_tokens_from_messages
+from common.tracing import instant, span
+from common.usage import PROCESS_METER, record_usage
+
 load_dotenv(dotenv_path="../.env")
 openai.api_key = os.getenv("API_KEY")
 
-def chat(messages):
+MODEL = "gpt-3.5-turbo"
+# Token budget for the conversation history sent with each request. Older turns are summarized once it's exceeded.
+# None uses the model's context size minus room for the reply.
+CONTEXT_TOKEN_BUDGET = None
+
+# Streamed text is written to the terminal at most this often (in seconds), instead of once per delta.
+FLUSH_INTERVAL = 0.05
+
+
+@dataclass
+class StreamStats:
+    time_to_first_token: float = 0.0
+    chunks: int = 0
+    elapsed: float = 0.0
+    overhead: float = 0.0  # time spent handling chunks locally, excluding waiting on the network
+
+    def __str__(self) -> str:
+        per_chunk = self.overhead / self.chunks if self.chunks else 0.0
+        return (f"[time to first token: {self.time_to_first_token * 1000:.0f} ms | {self.chunks} chunks in "
+                f"{self.elapsed:.2f} s | overhead: {per_chunk * 1e6:.1f} µs/chunk]")
+
+
+async def stream_chat(messages, stats: StreamStats) -> AsyncIterator[str]:
+    """
+    Yield the content deltas of a streamed completion, recording the time to first token in `stats` and the usage of
+    the request in common.usage. The request goes through the limiter shared by every caller of MODEL.
+    """
+    limiter = limiter_for(MODEL)
+    prompt_tokens = num_tokens_from_messages(messages, MODEL)
+    estimate = estimate_chat_tokens(messages, MODEL)
+
+    async def send():
+        with span("request.send", model=MODEL, call_site="chatbot.reply"):
+            return await openai.ChatCompletion.acreate(
+                model=MODEL,
+                messages=messages,
+                temperature=0.8,
+                stream=True
+            )
+
+    start = time.perf_counter()
+    # Only opening the stream is retried, since deltas already passed on can't be taken back. The limiter's slot is
+    # held until the response starts, not while the caller reads it.
+    response = await acall_with_retries(send, limiter, estimate)
+    received = []
+    try:
+        # The span includes the time the caller takes to handle each delta, as the stream isn't read meanwhile.
+        with span("request.stream", model=MODEL, call_site="chatbot.reply"):
+            async for chunk in response:
+                if not stats.chunks:
+                    stats.time_to_first_token = time.perf_counter() - start
+                    instant("request.first_byte", model=MODEL, call_site="chatbot.reply")
+                stats.chunks += 1
+                if (not chunk.choices[0].delta):
+                    break
+                content = chunk.choices[0].delta.get("content", "")
+                received.append(content)
+                yield content
+    finally:
+        await response.aclose()
+        # Streamed responses don't report their usage, so it is counted from what was sent and received. A reply
+        # cancelled part way is counted up to where it stopped.
+        completion_tokens = count_tokens("".join(received), MODEL)
+        limiter.adjust(prompt_tokens + completion_tokens - estimate)
+        record_usage(MODEL, prompt_tokens, completion_tokens, time.perf_counter() - start, estimated=True,
+                     call_site="chatbot.reply")
+
+
+async def chat(messages):
     print(colored(f"\nAssistant: \n", "green"), end="")
-    complete_response = ""
-
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=messages,
-        temperature=0.8,
-        stream=True
-    )
-
-    for chunk in response:
-        if (not chunk.choices[0].delta):
-            break
-        content = chunk.choices[0].delta.content
-        print(colored(content, "green"), end="", flush=True)
-        complete_response += content
+    complete_response = io.StringIO()
+    pending = []
+    stats = StreamStats()
+    start = last_flush = time.perf_counter()
+
+    def flush():
+        if pending:
+            print(colored("".join(pending), "green"), end="", flush=True)
+            pending.clear()
+
+    stream = stream_chat(messages, stats)
+    try:
+        async for content in stream:
+            received = time.perf_counter()
+            complete_response.write(content)
+            pending.append(content)
+            if received - last_flush >= FLUSH_INTERVAL:
+                flush()
+                last_flush = time.perf_counter()
+            stats.overhead += time.perf_counter() - received
+    except asyncio.CancelledError:
+        # Keep what was generated so far and go back to the prompt, the session carries on.
+        await stream.aclose()
+        flush()
+        print(colored("\n[generation cancelled]", "yellow"), end="")
+    flush()
+    stats.elapsed = time.perf_counter() - start
     print("\n")
-    return {"role": "assistant", "content": complete_response}
+    print(colored(f"{stats}\n", attrs=["dark"]))
+    return {"role": "assistant", "content": complete_response.getvalue()}
 
-def main():
+
+async def ainput(prompt: str) -> str:
+    """
+    Read a line from stdin without blocking the event loop. The read runs on a daemon thread, so exiting the program
+    doesn't wait for a pending input() call.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(e))
+        else:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(line))
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+async def generate(messages):
+    """
+    Run chat() so that Ctrl+C cancels the reply being generated instead of ending the session.
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(chat(messages))
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except (NotImplementedError, RuntimeError):
+        # Signal handlers aren't supported on this platform; Ctrl+C will end the session as before.
+        return await task
+    try:
+        return await task
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+
+
+async def chat_session():
     print(colored("Assistant: Hello! I'm a chatbot. How can I help you today?\n", "green"))
+    print(colored("Press Ctrl+C while the assistant is replying to stop the reply, or at the prompt to exit.\n", attrs=["dark"]))
 
-    messages = [{"role": "system", "content": "You are a helpful conversational chatbot"}]
+    context = ConversationContext("You are a helpful conversational chatbot", MODEL, max_tokens=CONTEXT_TOKEN_BUDGET)
 
     while True:
-        try:
-            prompt = input("You: ")
-            messages.append({"role": "user", "content": prompt})
-            messages.append(chat(messages))
-        except KeyboardInterrupt:
-            print("\n\nGood Bye!\n\n")
-            break;
+        prompt = await ainput("You: ")
+        context.append({"role": "user", "content": prompt})
+        await context.fit()
+        context.append(await generate(context.messages))
+
+
+def main():
+    try:
+        asyncio.run(chat_session())
+    except (KeyboardInterrupt, EOFError):
+        print(colored(f"\n\nUsed {PROCESS_METER} (token counts of streamed replies are estimated)", attrs=["dark"]))
+        print("\n\nGood Bye!\n\n")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
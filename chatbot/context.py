@@ -0,0 +1,118 @@
+from typing import Dict, List, Optional
+
+from openai.error import APIConnectionError, APIError, RateLimitError
+
+from common.client import achat_completion
+from common.tokens import count_tokens, message_token_overhead, model_context_size
+
+# Tokens kept free for the assistant's reply when the budget is derived from the model's context size.
+REPLY_TOKEN_RESERVE = 1000
+# When the budget is exceeded, older turns are removed until the history is back under this fraction of it, so the
+# trimming (and summarizing) happens every few turns rather than on every turn.
+TRIM_TARGET_RATIO = 0.75
+SUMMARY_TOKEN_TARGET = 300
+MAX_ATTEMPTS = 3
+
+
+def conversation_summary_messages(transcript: str, target_summary_size: int) -> List[Dict]:
+    # Craft the list of messages that will be sent to the model to condense older turns of the conversation.
+    return [
+        {
+            "role": "system",
+            "content": f"""
+You are condensing the earlier part of a conversation between a user and an assistant so that it can continue
+without the full transcript. If the transcript starts with a summary of even earlier turns, fold it into yours.
+Keep the facts, names, decisions and open questions the assistant needs to continue the conversation.
+Strive to make your summary as detailed as possible while remaining under a {target_summary_size} token limit.
+""".strip(),
+        },
+        {"role": "user", "content": f"Summarize the following conversation: {transcript}"},
+    ]
+
+
+async def summarize_turns(messages: List[Dict], model: str, target_summary_size: int = SUMMARY_TOKEN_TARGET) -> str:
+    """
+    Condense a list of messages into a short summary, through the model's shared limiter and with the retries of
+    common.client.
+    """
+    transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    result = await achat_completion(conversation_summary_messages(transcript, target_summary_size), model,
+                                    max_attempts=MAX_ATTEMPTS, call_site="chatbot.summarize")
+    return result.choices[0].message.to_dict()["content"]
+
+
+class ConversationContext:
+    """
+    The message history sent to the model, kept under a token budget.
+
+    Each message is counted once when it is added, so the size of the history is known without re-encoding it.
+    Once the history exceeds `max_tokens`, the oldest turns are removed and, if `summarize` is set, replaced by a
+    model-written summary of them, so the size of every request stays bounded however long the session runs.
+    """
+
+    def __init__(self, system_prompt: str, model: str, max_tokens: Optional[int] = None, summarize: bool = True):
+        self.model = model
+        self.max_tokens = max_tokens or model_context_size(model) - REPLY_TOKEN_RESERVE
+        self.summarize = summarize
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.summary_message: Optional[Dict] = None
+        self.turns: List[Dict] = []
+        self._turn_tokens: List[int] = []
+        self._tokens_per_message, self._tokens_per_name = message_token_overhead(model)
+
+    def _message_tokens(self, message: Dict) -> int:
+        num_tokens = self._tokens_per_message
+        for key, value in message.items():
+            num_tokens += count_tokens(value, self.model)
+            if key == "name":
+                num_tokens += self._tokens_per_name
+        return num_tokens
+
+    @property
+    def messages(self) -> List[Dict]:
+        prefix = [self.system_message] if self.summary_message is None else [self.system_message, self.summary_message]
+        return prefix + self.turns
+
+    @property
+    def tokens(self) -> int:
+        """
+        Number of tokens the current history uses as a prompt.
+        """
+        num_tokens = self._message_tokens(self.system_message) + sum(self._turn_tokens)
+        if self.summary_message is not None:
+            num_tokens += self._message_tokens(self.summary_message)
+        return num_tokens + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    def append(self, message: Dict) -> None:
+        self.turns.append(message)
+        self._turn_tokens.append(self._message_tokens(message))
+
+    def pop(self) -> Dict:
+        """
+        Remove and return the most recent message, e.g. a user turn that got no reply.
+        """
+        self._turn_tokens.pop()
+        return self.turns.pop()
+
+    async def fit(self) -> None:
+        """
+        Trim the history to the budget if it has grown past it. The most recent message is always kept.
+        """
+        if self.tokens <= self.max_tokens:
+            return
+
+        target = self.max_tokens * TRIM_TARGET_RATIO
+        removed = []
+        while len(self.turns) > 1 and self.tokens > target:
+            removed.append(self.turns.pop(0))
+            self._turn_tokens.pop(0)
+        if not removed or not self.summarize:
+            return
+
+        previous = [self.summary_message] if self.summary_message is not None else []
+        try:
+            summary = await summarize_turns(previous + removed, self.model)
+        except (APIConnectionError, APIError, RateLimitError):
+            # Losing the older turns is better than failing the conversation.
+            return
+        self.summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
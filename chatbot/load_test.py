@@ -0,0 +1,113 @@
+"""
+Load test for the chatbot server.
+
+Without --server, a mock completion backend (common/mock_openai.py) and the chatbot server are started in-process on
+local ports, so the test runs without the OpenAI API. Each simulated user opens a session and sends its messages one
+after another; the time to first token is measured from sending a message to receiving the first content event.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import List, Optional
+
+import aiohttp
+import openai
+from aiohttp import web
+
+import server
+from common.client import configure
+from common.mock_openai import MockConfig, create_app as create_mock_app
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_user(http: aiohttp.ClientSession, base_url: str, messages: int, ttfts: List[float],
+                   errors: List[str]) -> None:
+    async with http.post(f"{base_url}/sessions") as response:
+        session_id = (await response.json())["session_id"]
+
+    for i in range(messages):
+        start = time.perf_counter()
+        first_token: Optional[float] = None
+        async with http.post(f"{base_url}/sessions/{session_id}/messages", json={"content": f"Message {i}"}) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                if first_token is None and line.startswith(b"data: ") and b'"content"' in line:
+                    first_token = time.perf_counter() - start
+                elif line.startswith(b"event: error"):
+                    errors.append(session_id)
+        if first_token is not None:
+            ttfts.append(first_token)
+
+    async with http.delete(f"{base_url}/sessions/{session_id}"):
+        pass
+
+
+async def start_site(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def site_url(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
+
+
+async def load_test(sessions: int, messages: int, base_url: Optional[str], mock_config: MockConfig) -> None:
+    runners = []
+    if base_url is None:
+        mock_runner = await start_site(create_mock_app(mock_config))
+        openai.api_base = f"{site_url(mock_runner)}/v1"
+        openai.api_key = openai.api_key or "mock"
+        # The mock has no quotas, so only the server itself is measured.
+        configure(server.MODEL, None, None, None)
+        server_runner = await start_site(server.create_app())
+        runners = [server_runner, mock_runner]
+        base_url = site_url(server_runner)
+
+    ttfts: List[float] = []
+    errors: List[str] = []
+    start = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as http:
+        await asyncio.gather(*(run_user(http, base_url, messages, ttfts, errors) for _ in range(sessions)))
+    elapsed = time.perf_counter() - start
+
+    for runner in runners:
+        await runner.cleanup()
+
+    print(json.dumps({
+        "sessions": sessions,
+        "messages_per_session": messages,
+        "replies": len(ttfts),
+        "errors": len(errors),
+        "wall_time": round(elapsed, 3),
+        "replies_per_second": round(len(ttfts) / elapsed, 2),
+        "ttft_p50_ms": round(statistics.median(ttfts) * 1000, 1) if ttfts else None,
+        "ttft_p99_ms": round(percentile(ttfts, 0.99) * 1000, 1) if ttfts else None,
+    }, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chatbot server")
+    parser.add_argument("--sessions", type=int, default=50, help="Number of concurrent sessions")
+    parser.add_argument("--messages", type=int, default=3, help="Messages sent by each session")
+    parser.add_argument("--server", help="URL of a running chatbot server (default: start one against a local mock)")
+    parser.add_argument("--first-token-latency", type=float, default=MockConfig.first_token_latency)
+    parser.add_argument("--tokens-per-second", type=float, default=MockConfig.tokens_per_second)
+    args = parser.parse_args()
+
+    mock_config = MockConfig(first_token_latency=args.first_token_latency, tokens_per_second=args.tokens_per_second)
+    asyncio.run(load_test(args.sessions, args.messages, args.server, mock_config))
+
+
+if __name__ == "__main__":
+    main()
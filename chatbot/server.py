@@ -0,0 +1,179 @@
+"""
+Serve the chatbot over HTTP to many users at once.
+
+    POST   /sessions                      -> {"session_id": "..."}
+    POST   /sessions/{session_id}/messages   {"content": "..."} -> text/event-stream of the reply
+    DELETE /sessions/{session_id}
+    GET    /metrics                       -> token usage, cost and latency in the Prometheus text format
+
+The reply is streamed as server-sent events: one `data: {"content": "..."}` event per delta, then a `done` event
+carrying the stream statistics, or an `error` event if the backend failed. All sessions share one keep-alive
+connection pool to the completion backend, and the rate limiter of the model (see common.client; --rpm and --tpm set
+its quotas).
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+import uuid
+from dataclasses import dataclass, field
+
+import aiohttp
+import openai
+from aiohttp import web
+from openai.error import OpenAIError
+
+from chatbot import CONTEXT_TOKEN_BUDGET, MODEL, StreamStats, stream_chat
+from common.client import configure, default_rate_limits
+from context import ConversationContext
+from common import tracing
+from common.usage import PROCESS_METER, usage_labels
+
+SYSTEM_PROMPT = "You are a helpful conversational chatbot"
+# Replies a single session may be generating at the same time. Further messages are rejected with 429.
+MAX_REQUESTS_PER_SESSION = 1
+# Connections kept open to the completion backend, shared by every session.
+BACKEND_POOL_SIZE = 100
+BACKEND_KEEPALIVE_TIMEOUT = 30
+# Sessions idle for longer than this (in seconds) are discarded.
+SESSION_IDLE_TIMEOUT = 3600
+
+
+@dataclass
+class Session:
+    context: ConversationContext
+    slots: asyncio.Semaphore = field(default_factory=lambda: asyncio.Semaphore(MAX_REQUESTS_PER_SESSION))
+    last_used: float = field(default_factory=time.monotonic)
+
+
+def get_session(request: web.Request) -> Session:
+    session = request.app["sessions"].get(request.match_info["session_id"])
+    if session is None:
+        raise web.HTTPNotFound(text=json.dumps({"error": "unknown session"}), content_type="application/json")
+    session.last_used = time.monotonic()
+    return session
+
+
+async def create_session(request: web.Request) -> web.Response:
+    sessions = request.app["sessions"]
+    now = time.monotonic()
+    for session_id in [key for key, session in sessions.items() if now - session.last_used > SESSION_IDLE_TIMEOUT]:
+        del sessions[session_id]
+
+    session_id = uuid.uuid4().hex
+    sessions[session_id] = Session(ConversationContext(SYSTEM_PROMPT, MODEL, max_tokens=CONTEXT_TOKEN_BUDGET))
+    return web.json_response({"session_id": session_id}, status=201)
+
+
+async def delete_session(request: web.Request) -> web.Response:
+    get_session(request)
+    del request.app["sessions"][request.match_info["session_id"]]
+    return web.Response(status=204)
+
+
+async def post_message(request: web.Request) -> web.StreamResponse:
+    session = get_session(request)
+    body = await request.json()
+    if session.slots.locked():
+        raise web.HTTPTooManyRequests(text=json.dumps({"error": "a reply is already being generated"}),
+                                      content_type="application/json")
+
+    async with session.slots:
+        # Route this request's backend calls through the shared connection pool.
+        openai.aiosession.set(request.app["backend"])
+
+        # Every request made for this message, including a summary of older turns, is labelled with the session.
+        with usage_labels(document=request.match_info["session_id"]):
+            session.context.append({"role": "user", "content": body["content"]})
+            await session.context.fit()
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await response.prepare(request)
+
+            stats = StreamStats()
+            start = time.perf_counter()
+            complete_response = io.StringIO()
+            finished = False
+            try:
+                try:
+                    async for content in stream_chat(session.context.messages, stats):
+                        complete_response.write(content)
+                        await response.write(f"data: {json.dumps({'content': content})}\n\n".encode("utf-8"))
+                except OpenAIError as e:
+                    # The 200 status is already sent, so the failure is reported as an event at the end of the stream.
+                    error = {"error": f"{type(e).__name__}: {e}"}
+                    await response.write(f"event: error\ndata: {json.dumps(error)}\n\n".encode("utf-8"))
+                else:
+                    stats.elapsed = time.perf_counter() - start
+                    done = {"time_to_first_token": stats.time_to_first_token, "chunks": stats.chunks,
+                            "elapsed": stats.elapsed}
+                    await response.write(f"event: done\ndata: {json.dumps(done)}\n\n".encode("utf-8"))
+                    finished = True
+                await response.write_eof()
+            finally:
+                reply = complete_response.getvalue()
+                if reply:
+                    # If the reply failed or the client went away part way, keep the part that was generated, like
+                    # the terminal chatbot does.
+                    session.context.append({"role": "assistant", "content": reply})
+                elif not finished:
+                    # Nothing was generated; drop the message so later requests don't carry an unanswered turn.
+                    session.context.pop()
+            return response
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(text=PROCESS_METER.prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def open_backend(app: web.Application) -> None:
+    connector = aiohttp.TCPConnector(limit=BACKEND_POOL_SIZE, keepalive_timeout=BACKEND_KEEPALIVE_TIMEOUT)
+    app["backend"] = aiohttp.ClientSession(connector=connector)
+
+
+async def close_backend(app: web.Application) -> None:
+    await app["backend"].close()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app["sessions"] = {}
+    app.on_startup.append(open_backend)
+    app.on_cleanup.append(close_backend)
+    app.router.add_post("/sessions", create_session)
+    app.router.add_delete("/sessions/{session_id}", delete_session)
+    app.router.add_post("/sessions/{session_id}/messages", post_message)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chatbot server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--api-base", help="Completion backend to use instead of the OpenAI API, e.g. a local mock")
+    parser.add_argument("--rpm", type=float, help="Maximum requests per minute (default: the model's quota)")
+    parser.add_argument("--tpm", type=float, help="Maximum tokens per minute (default: the model's quota)")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Record where the time goes and write it to PATH in the Chrome trace format on exit")
+    args = parser.parse_args()
+
+    if args.api_base:
+        openai.api_base = args.api_base
+        openai.api_key = openai.api_key or "mock"
+    if args.rpm or args.tpm:
+        requests_per_minute, tokens_per_minute = default_rate_limits(MODEL)
+        configure(MODEL, args.rpm or requests_per_minute, args.tpm or tokens_per_minute)
+    if args.trace:
+        tracing.enable()
+    try:
+        web.run_app(create_app(), host=args.host, port=args.port)
+    finally:
+        if args.trace:
+            tracing.write_trace(args.trace)
+            print(tracing.format_summary())
+
+
+if __name__ == "__main__":
+    main()
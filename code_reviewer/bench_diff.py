@@ -0,0 +1,92 @@
+"""
+Benchmark of the diff engines in diff_engine.py on synthetic files.
+
+The inputs mimic generated code and data tables: most lines come from a small pool of repeated lines, with unique
+lines mixed in, and a few percent of the lines are changed, inserted or deleted. Each engine's hunks are applied back
+to the original, timed as apply_seconds, to check that they reproduce the changed file.
+"""
+import argparse
+import json
+import random
+import time
+from typing import List, Tuple
+
+from diff_engine import DIFF_ENGINES, diff_hunks
+from patch import apply_hunks
+
+REPEATED_LINES = [
+    "",
+    "    },",
+    "    {",
+    '        "enabled": true,',
+    '        "enabled": false,',
+    "        return None",
+    "    pass",
+    "0, 0, 0, 0, 0, 0, 0, 0,",
+]
+
+
+def synthetic_pair(lines: int, change_rate: float, unique_rate: float, seed: int) -> Tuple[str, str]:
+    rng = random.Random(seed)
+
+    def make_line(i: int) -> str:
+        if rng.random() < unique_rate:
+            return f'        "field_{i}_{rng.randrange(1 << 30)}": {rng.randrange(1000)},'
+        return rng.choice(REPEATED_LINES)
+
+    original = [make_line(i) for i in range(lines)]
+    changed: List[str] = []
+    for i, line in enumerate(original):
+        roll = rng.random()
+        if roll < change_rate / 3:
+            continue
+        elif roll < change_rate * 2 / 3:
+            changed.append(make_line(lines + i))
+        elif roll < change_rate:
+            changed.extend([line, make_line(lines + i)])
+        else:
+            changed.append(line)
+    return "\n".join(original) + "\n", "\n".join(changed) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the diff engines on synthetic inputs")
+    parser.add_argument("--lines", type=int, nargs="+", default=[10_000, 30_000, 100_000])
+    parser.add_argument("--engines", nargs="+", default=list(DIFF_ENGINES), choices=list(DIFF_ENGINES))
+    parser.add_argument("--change-rate", type=float, default=0.02, help="Fraction of lines changed")
+    parser.add_argument("--unique-rate", type=float, default=0.3, help="Fraction of lines that are unique")
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="Skip an engine on larger inputs once a run takes longer than this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = []
+    too_slow = set()
+    for lines in args.lines:
+        original, changed = synthetic_pair(lines, args.change_rate, args.unique_rate, args.seed)
+        for engine in args.engines:
+            if engine in too_slow:
+                results.append({"lines": lines, "engine": engine, "seconds": None})
+                continue
+            start = time.perf_counter()
+            hunks = diff_hunks(original, changed, engine=engine)
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            applied = apply_hunks(original, hunks)
+            apply_elapsed = time.perf_counter() - start
+            results.append({
+                "lines": lines,
+                "engine": engine,
+                "seconds": round(elapsed, 3),
+                "apply_seconds": round(apply_elapsed, 3),
+                "hunks": len(hunks),
+                "changed_lines": sum(1 for hunk in hunks for line in hunk.lines if line[0] != " "),
+                "round_trip": applied == changed,
+            })
+            if elapsed > args.timeout:
+                too_slow.add(engine)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import ast
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from util import num_tokens_from_messages
+
+
+@dataclass
+class ReviewUnit:
+    """
+    A range of lines of a file that is reviewed on its own. start is the 0-based index of the first line and end is
+    exclusive. text is the lines joined back together, with their line endings.
+    """
+    name: str
+    start: int
+    end: int
+    text: str
+
+
+@dataclass
+class MergeConflict:
+    unit: ReviewUnit
+    reason: str
+
+
+def unit_tokens(text: str, model: str) -> int:
+    return num_tokens_from_messages([{'role': 'user', 'content': text}], model)
+
+
+def _node_start(node: ast.stmt) -> int:
+    # Decorators belong to the function or class they decorate.
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [decorator.lineno for decorator in decorators]) - 1
+
+
+def _split_body(nodes: List[ast.stmt], start: int, end: int, prefix: str) -> List[Tuple[str, int, int, Optional[ast.stmt]]]:
+    """
+    Cut the lines [start, end) at the start of every statement in `nodes`. Lines before the first statement (a class
+    header, comments, imports) form a unit of their own.
+    """
+    ranges = []
+    boundaries = [_node_start(node) for node in nodes]
+    if not boundaries or boundaries[0] > start:
+        ranges.append((f"{prefix}<header>" if prefix else "<module code>", start, boundaries[0] if boundaries else end, None))
+    for i, node in enumerate(nodes):
+        node_end = boundaries[i + 1] if i + 1 < len(nodes) else end
+        name = getattr(node, "name", None)
+        ranges.append((f"{prefix}{name}" if name else f"{prefix}<class code>" if prefix else "<module code>",
+                       boundaries[i], node_end, node))
+    return ranges
+
+
+def _split_lines(name: str, lines: List[str], start: int, end: int, model: str, max_tokens: int) -> List[ReviewUnit]:
+    """
+    Fallback for code that has no structure to split on: consecutive runs of lines under max_tokens.
+    """
+    units = []
+    unit_start = start
+    tokens = 0
+    for i in range(start, end):
+        line_tokens = unit_tokens(lines[i], model)
+        if tokens + line_tokens > max_tokens and i > unit_start:
+            units.append(ReviewUnit(f"{name}[{unit_start + 1}-{i}]", unit_start, i, "".join(lines[unit_start:i])))
+            unit_start, tokens = i, 0
+        tokens += line_tokens
+    if unit_start < end:
+        units.append(ReviewUnit(f"{name}[{unit_start + 1}-{end}]", unit_start, end, "".join(lines[unit_start:end])))
+    return units
+
+
+def split_into_units(source: str, model: str, max_tokens: int) -> List[ReviewUnit]:
+    """
+    Split a Python file into units of at most max_tokens along its structure: top-level functions and classes, and
+    the methods of classes that are too large on their own. Adjacent small units are merged back together so the
+    number of requests stays low. Code that can't be parsed, or a single function that is still too large, is split
+    into runs of lines.
+    """
+    lines = source.splitlines(keepends=True)
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return _split_lines("<file>", lines, 0, len(lines), model, max_tokens)
+
+    pieces: List[ReviewUnit] = []
+    pending = _split_body(tree.body, 0, len(lines), "")
+    while pending:
+        name, start, end, node = pending.pop(0)
+        text = "".join(lines[start:end])
+        if unit_tokens(text, model) <= max_tokens:
+            pieces.append(ReviewUnit(name, start, end, text))
+        elif isinstance(node, ast.ClassDef) and node.body:
+            pending[0:0] = _split_body(node.body, start, end, f"{name}.")
+        else:
+            pieces.extend(_split_lines(name, lines, start, end, model, max_tokens))
+
+    units: List[ReviewUnit] = []
+    for piece in pieces:
+        if units:
+            merged = units[-1].text + piece.text
+            if unit_tokens(merged, model) <= max_tokens:
+                names = units[-1].name.split(", ")
+                name = units[-1].name if names[-1] == piece.name else f"{units[-1].name}, {piece.name}"
+                units[-1] = ReviewUnit(name, units[-1].start, piece.end, merged)
+                continue
+        units.append(piece)
+    return units
+
+
+def merge_unit_edits(source: str, edits: List[Tuple[ReviewUnit, str]]) -> Tuple[str, List[MergeConflict]]:
+    """
+    Replace the lines of each unit with its edited text. An edit conflicts, and is left out, when its unit overlaps
+    a unit that was already merged or when the file no longer contains the unit's original text at its position.
+    """
+    lines = source.splitlines(keepends=True)
+    conflicts: List[MergeConflict] = []
+    accepted: List[Tuple[ReviewUnit, str]] = []
+    for unit, new_text in sorted(edits, key=lambda edit: edit[0].start):
+        # Defensive: units from one split_into_units call over `source` never overlap or go stale, but the checks keep
+        # a bad edit from silently corrupting the file if that ever changes.
+        if accepted and unit.start < accepted[-1][0].end:
+            conflicts.append(MergeConflict(unit, f"overlaps the edit to {accepted[-1][0].name}"))
+        elif "".join(lines[unit.start:unit.end]) != unit.text:
+            conflicts.append(MergeConflict(unit, "the file changed since it was split"))
+        else:
+            accepted.append((unit, new_text))
+
+    # Apply from the bottom up so the line numbers of the remaining units stay valid.
+    for unit, new_text in reversed(accepted):
+        if new_text and not new_text.endswith("\n") and unit.end < len(lines):
+            new_text += "\n"
+        lines[unit.start:unit.end] = new_text.splitlines(keepends=True)
+    return "".join(lines), conflicts
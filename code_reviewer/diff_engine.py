@@ -0,0 +1,226 @@
+"""
+Line diff engines producing structured hunks (see patch.Hunk) that can be formatted or applied back with apply_hunks.
+
+"patience" is the default: it anchors on lines that occur exactly once on both sides, recurses between the anchors,
+and runs Myers' O(ND) algorithm only on the small regions left without anchors. That keeps it close to linear on
+typical edits, including files with many repeated lines, where difflib's SequenceMatcher degrades badly. "myers" runs
+Myers on the whole input, and "difflib" is the original SequenceMatcher path, kept for comparison.
+"""
+from bisect import bisect_left
+from difflib import SequenceMatcher
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from patch import Hunk
+
+Opcode = Tuple[str, int, int, int, int]
+
+# Regions whose Myers edit distance would exceed this are reported as a single replacement instead, which bounds the
+# time spent on inputs that have little in common.
+MAX_MYERS_COST = 2000
+
+
+def _intern(a: Sequence[str], b: Sequence[str]) -> Tuple[List[int], List[int]]:
+    # Comparing small ints is cheaper than comparing strings.
+    ids: Dict[str, int] = {}
+    return [ids.setdefault(line, len(ids)) for line in a], [ids.setdefault(line, len(ids)) for line in b]
+
+
+def _myers(a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int,
+           max_cost: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Matching (i, j) pairs of a shortest edit script between a[alo:ahi] and b[blo:bhi], or None if it needs more than
+    max_cost edits.
+    """
+    n, m = ahi - alo, bhi - blo
+    v = {1: 0}
+    trace = []
+    for d in range(min(n + m, max_cost) + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v.get(k - 1, -1) < v.get(k + 1, -1)):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _myers_backtrack(trace, n, m, alo, blo)
+    return None
+
+
+def _myers_backtrack(trace: List[Dict[int, int]], n: int, m: int, alo: int, blo: int) -> List[Tuple[int, int]]:
+    matches = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v.get(k - 1, -1) < v.get(k + 1, -1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v.get(prev_k, 0)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        x, y = prev_x, prev_y
+    matches.reverse()
+    return matches
+
+
+def _unique_anchors(a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int) -> List[Tuple[int, int]]:
+    """
+    Pairs of positions of lines that occur exactly once in both ranges, reduced to their longest increasing run.
+    """
+    in_a: Dict[int, int] = {}
+    for i in range(alo, ahi):
+        in_a[a[i]] = -1 if a[i] in in_a else i
+    in_b: Dict[int, int] = {}
+    for j in range(blo, bhi):
+        if in_a.get(b[j], -1) != -1:
+            in_b[b[j]] = -1 if b[j] in in_b else j
+    pairs = [(in_a[line], j) for line, j in in_b.items() if j != -1]
+    pairs.sort()
+
+    # Longest increasing subsequence of the b positions (patience sorting).
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous: List[int] = []
+    for index, (_, j) in enumerate(pairs):
+        position = bisect_left(tails, j)
+        if position == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[position] = j
+            tail_index[position] = index
+        previous.append(tail_index[position - 1] if position else -1)
+    anchors = []
+    index = tail_index[-1] if tail_index else -1
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _patience_matches(a: List[int], b: List[int]) -> List[Tuple[int, int]]:
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            previous_i, previous_j = alo, blo
+            for i, j in anchors:
+                matches.append((i, j))
+                regions.append((previous_i, i, previous_j, j))
+                previous_i, previous_j = i + 1, j + 1
+            regions.append((previous_i, ahi, previous_j, bhi))
+        else:
+            matches.extend(_myers(a, b, alo, ahi, blo, bhi, MAX_MYERS_COST) or [])
+    matches.sort()
+    return matches
+
+
+def _opcodes_from_matches(matches: List[Tuple[int, int]], n: int, m: int) -> List[Opcode]:
+    opcodes = []
+    i = j = 0
+    for mi, mj in matches + [(n, m)]:
+        if i < mi and j < mj:
+            opcodes.append(("replace", i, mi, j, mj))
+        elif i < mi:
+            opcodes.append(("delete", i, mi, j, j))
+        elif j < mj:
+            opcodes.append(("insert", i, i, j, mj))
+        if mi < n or mj < m:
+            if opcodes and opcodes[-1][0] == "equal" and opcodes[-1][2] == mi:
+                _, start_i, _, start_j, _ = opcodes[-1]
+                opcodes[-1] = ("equal", start_i, mi + 1, start_j, mj + 1)
+            else:
+                opcodes.append(("equal", mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return opcodes
+
+
+def patience_opcodes(a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+    a_ids, b_ids = _intern(a, b)
+    return _opcodes_from_matches(_patience_matches(a_ids, b_ids), len(a), len(b))
+
+
+def myers_opcodes(a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+    a_ids, b_ids = _intern(a, b)
+    matches = _myers(a_ids, b_ids, 0, len(a), 0, len(b), len(a) + len(b))
+    return _opcodes_from_matches(matches, len(a), len(b))
+
+
+def difflib_opcodes(a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+    return SequenceMatcher(None, a, b).get_opcodes()
+
+
+DIFF_ENGINES: Dict[str, Callable[[Sequence[str], Sequence[str]], List[Opcode]]] = {
+    "patience": patience_opcodes,
+    "myers": myers_opcodes,
+    "difflib": difflib_opcodes,
+}
+DEFAULT_DIFF_ENGINE = "patience"
+
+
+def _group_opcodes(opcodes: List[Opcode], context: int) -> List[List[Opcode]]:
+    # Same grouping as SequenceMatcher.get_grouped_opcodes, for opcodes from any engine.
+    if not opcodes:
+        return []
+    opcodes = list(opcodes)
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return groups
+
+
+def diff_hunks(original: str, changed: str, context: int = 3, engine: str = DEFAULT_DIFF_ENGINE) -> List[Hunk]:
+    """
+    Diff two texts line by line into hunks with `context` lines of context around each change.
+    """
+    a = original.splitlines()
+    b = changed.splitlines()
+    hunks = []
+    for group in _group_opcodes(DIFF_ENGINES[engine](a, b), context):
+        hunk = Hunk(old_start=group[0][1] + 1, new_start=group[0][3] + 1)
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                hunk.lines.extend(" " + line for line in a[i1:i2])
+                continue
+            hunk.lines.extend("-" + line for line in a[i1:i2])
+            hunk.lines.extend("+" + line for line in b[j1:j2])
+        hunks.append(hunk)
+    return hunks
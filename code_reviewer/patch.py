@@ -0,0 +1,119 @@
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class PatchError(Exception):
+    pass
+
+
+@dataclass
+class Hunk:
+    """
+    One hunk of a unified diff. `lines` keeps the diff markers: ' ' for context, '-' for removed and '+' for added
+    lines, followed by the line without its line ending. old_start and new_start are 1-based, as in the hunk header.
+    """
+    old_start: int
+    lines: List[str] = field(default_factory=list)
+    new_start: int = 0
+
+    @property
+    def old_lines(self) -> List[str]:
+        return [line[1:] for line in self.lines if line[0] in " -"]
+
+    @property
+    def new_lines(self) -> List[str]:
+        return [line[1:] for line in self.lines if line[0] in " +"]
+
+
+def parse_unified_diff(patch: str) -> List[Hunk]:
+    """
+    Parse the hunks of a unified diff. The file header and '\\ No newline' markers are ignored. A diff without any
+    hunk header is read as a single hunk, since models often leave the header out.
+    """
+    hunks: List[Hunk] = []
+    for line in patch.splitlines():
+        match = HUNK_HEADER.match(line)
+        if match:
+            # An empty range names the line before it, see _format_range.
+            old_start = int(match.group(1)) + (match.group(2) == "0")
+            new_start = int(match.group(3)) + (match.group(4) == "0")
+            hunks.append(Hunk(old_start=old_start, new_start=new_start))
+        elif line.startswith("\\") or (not hunks and (line.startswith("---") or line.startswith("+++"))):
+            continue
+        elif line[:1] in ("+", "-", " ") or line == "":
+            if not hunks:
+                if not line.strip():
+                    continue
+                hunks.append(Hunk(old_start=1, new_start=1))
+            hunks[-1].lines.append(line if line else " ")
+    # Trailing blank context lines are usually just the end of the CDATA block, indented to line up with ]]>.
+    for hunk in hunks:
+        while hunk.lines and not hunk.lines[-1].strip():
+            hunk.lines.pop()
+    return [hunk for hunk in hunks if any(line[0] in "+-" for line in hunk.lines)]
+
+
+def _format_range(start: int, count: int) -> str:
+    # Same convention as difflib: an empty range starts at the line before it, and a count of one is left out.
+    if count == 1:
+        return f"{start}"
+    if count == 0:
+        start -= 1
+    return f"{start},{count}"
+
+
+def format_hunk_header(hunk: Hunk) -> str:
+    old_count = sum(1 for line in hunk.lines if line[0] in " -")
+    new_count = sum(1 for line in hunk.lines if line[0] in " +")
+    return f"@@ -{_format_range(hunk.old_start, old_count)} +{_format_range(hunk.new_start, new_count)} @@"
+
+
+def format_unified_diff(hunks: List[Hunk]) -> str:
+    return "".join(f"{format_hunk_header(hunk)}\n" + "".join(f"{line}\n" for line in hunk.lines) for hunk in hunks)
+
+
+def _find(lines: List[str], needle: List[str], expected: int) -> int:
+    """
+    Index at which `needle` occurs in `lines`, ignoring trailing whitespace, searching outward from `expected`.
+    """
+    normalized = [line.rstrip() for line in needle]
+    last = len(lines) - len(needle)
+    if last < 0:
+        return -1
+    expected = min(max(expected, 0), last)
+    # Positions are tried in order of distance from `expected`, the lower one first on a tie. Hunks usually match at
+    # or near their header's line, so this stops after a few steps instead of ordering every line of the file.
+    for distance in range(max(expected, last - expected) + 1):
+        for i in (expected - distance, expected + distance) if distance else (expected,):
+            if 0 <= i <= last and all(lines[i + j].rstrip() == normalized[j] for j in range(len(needle))):
+                return i
+    return -1
+
+
+def apply_hunks(original: str, hunks: List[Hunk]) -> str:
+    """
+    Apply hunks to a text. Hunks are located by their context and removed lines, starting at the line number from
+    the header, so a patch with slightly wrong line numbers still applies. Raises PatchError if a hunk doesn't match.
+    """
+    lines = original.splitlines()
+    offset = 0
+    for hunk in hunks:
+        old_lines = hunk.old_lines
+        expected = max(0, hunk.old_start - 1 + offset)
+        if old_lines:
+            index = _find(lines, old_lines, expected)
+            if index == -1:
+                raise PatchError(f"Hunk at line {hunk.old_start} does not match the file:\n" + "\n".join(hunk.lines))
+        else:
+            index = min(expected, len(lines))
+        new_lines = hunk.new_lines
+        lines[index:index + len(old_lines)] = new_lines
+        offset += len(new_lines) - len(old_lines)
+
+    result = "\n".join(lines)
+    if lines and (original.endswith("\n") or not original):
+        result += "\n"
+    return result
@@ -1,118 +1,377 @@
 import argparse
+import contextvars
+import glob
 import logging
 import os
 import sys
+import time
 import openai
 import xml.etree.ElementTree as ElementTree
 from dotenv import load_dotenv
-from util import generate_initial_prompt, generate_diff
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from stream_parser import ReviewStreamParser
+from typing import Callable, Optional
+from chunking import ReviewUnit, merge_unit_edits, split_into_units
+from patch import PatchError, apply_hunks, parse_unified_diff
+from util import RateLimiter, generate_initial_prompt, generate_diff, model_context_size, num_tokens_from_messages
 from openai import OpenAIError
 
+# Make the shared modules in <repository_home>/common importable when running from this directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.client import call_with_retries, configure, default_rate_limits, estimate_chat_tokens, limiter_for
+from common import tracing
+from common.tokens import count_tokens
+from common.usage import metering, record_usage, usage_labels
+
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 load_dotenv(dotenv_path="../.env")
 openai.api_key = os.getenv("API_KEY")
 
+# Earlier suggestions (patches only) kept in the history of an interactive review.
+MAX_HISTORY_SUGGESTIONS = 5
+# Tokens left free for the reply. Files whose review request doesn't leave this much room are reviewed in parts.
+REPLY_TOKEN_RESERVE = 1000
+# Parts of one large file reviewed concurrently in batch mode, on top of the files being reviewed.
+UNIT_WORKERS = 4
+MAX_ATTEMPTS = 3
 
-@retry(
-    wait=wait_random_exponential(multiplier=1, max=10),
-    stop=stop_after_attempt(3),
-    retry=retry_if_exception_type(OpenAIError) | retry_if_exception_type(ElementTree.ParseError)
-)
-def get_review_result(messages: list[dict], model: str) -> tuple[str, str, dict]:
-    result = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=0.8
-    )
-    LOGGER.debug(f"Result Content: {result.choices[0].message.content}")
-    LOGGER.debug(f"Usage: {result.usage}")
-    result_content = result.choices[0].message.content
 
-    try:
-        root = ElementTree.fromstring(result_content)
-    except ElementTree.ParseError:
-        # attempt to find xml inside the text
-        LOGGER.debug(f"Parsing the response failed. Attempting to find the xml inside the response:\n{result_content}")
-        start_tag = '<root>'
-        end_tag = '</root>'
-
-        start_index = result_content.find(start_tag)
-        end_index = result_content.find(end_tag) + len(end_tag)
-        LOGGER.debug(f"Start Index: {start_index}, End Index: {end_index}")
-        if start_index != -1:
-            xml_content = result_content[start_index:end_index]
-            LOGGER.debug(f"XML Content: \n{xml_content}")
-            root = ElementTree.fromstring(xml_content)
-        else:
-            root = None
-    if root is not None:
-        code = root.find('code').text
-        explanation = root.find('explanation').text
-        return code, explanation, result.choices[0].message
-    else:
-        return "", result.choices[0].message.content, result.choices[0].message
+def get_review_result(messages: list[dict], model: str, on_explanation: Optional[Callable[[str], None]] = None,
+                      limiter: Optional[RateLimiter] = None, call_site: str = "reviewer.file") -> tuple[str, str, dict]:
+    """
+    Stream a review and parse it as it arrives (see ReviewStreamParser). Reading stops at </root>, and a response
+    whose structure breaks is abandoned right away: if the patch was already complete it is kept, otherwise the
+    ParseError triggers a retry without paying for the rest of the bad completion. Requests go through `limiter`,
+    by default the one shared by every caller of `model`, and every attempt is recorded in common.usage under
+    `call_site`.
+    """
+    prompt_tokens = num_tokens_from_messages(messages, model)
+
+    def stream_review() -> tuple[str, str, dict]:
+        start = time.perf_counter()
+        with tracing.span("request.send", model=model, call_site=call_site):
+            response = openai.ChatCompletion.create(
+                model=model,
+                messages=messages,
+                temperature=0.8,
+                stream=True
+            )
+        parser = ReviewStreamParser(on_explanation)
+        try:
+            with tracing.span("request.stream", model=model, call_site=call_site):
+                for i, chunk in enumerate(response):
+                    if not i:
+                        tracing.instant("request.first_byte", model=model, call_site=call_site)
+                    content = chunk.choices[0].delta.get("content")
+                    if content:
+                        parser.feed(content)
+                    if parser.done:
+                        break
+        except ElementTree.ParseError:
+            LOGGER.debug(f"Parsing the response failed, cancelling it:\n{parser.text}")
+            if parser.patch is None:
+                raise
+        finally:
+            response.close()
+            # Streamed responses don't report their usage, so it is counted from what was sent and received.
+            record_usage(model, prompt_tokens, count_tokens(parser.text, model), time.perf_counter() - start,
+                         estimated=True, call_site=call_site)
+
+        LOGGER.debug(f"Result Content: {parser.text}")
+        message = {'role': 'assistant', 'content': parser.text}
+        if not parser.has_xml:
+            return "", parser.text, message
+        if parser.patch is None:
+            raise ElementTree.ParseError("the review response ended before its patch was complete")
+        return parser.patch, parser.partial_explanation, message
 
+    return call_with_retries(stream_review, limiter or limiter_for(model), estimate_chat_tokens(messages, model),
+                             max_attempts=MAX_ATTEMPTS, retry_on=(ElementTree.ParseError,))
 
-def check_to_continue(file: str, model: str, messages: list[dict]) -> None:
+
+def check_to_continue() -> bool:
     user_decision = input("Would you like continue reviewing the file?[Type 'Y' for yes or any other key to exit]:")
     if user_decision.upper() == 'Y':
-        review_code(file, model, messages)
+        return True
+    print("Exiting the program. Good Bye!")
+    return False
+
+
+def review_request(file_contents: str, outcome: str = "") -> dict:
+    return {'role': 'user', 'content': f'{outcome}Suggest a single change for the code: {file_contents}'}
+
+
+@dataclass
+class UnitReview:
+    improved_code: str
+    explanation: str
+    errors: list[str]
+
+
+def review_units(file_contents: str, model: str, workers: int, rate_limiter: RateLimiter) -> UnitReview:
+    """
+    Review a file that is too large for one request. The file is split into token-bounded units along its structure,
+    the units are reviewed in parallel, and the suggested edits are merged back into the file. Edits that fail to
+    apply or conflict are reported in `errors` and left out.
+    """
+    budget = model_context_size(model) - num_tokens_from_messages(generate_initial_prompt(), model) - REPLY_TOKEN_RESERVE
+    units = split_into_units(file_contents, model, budget)
+    LOGGER.info(f"Reviewing {len(units)} units with {workers} workers")
+
+    def review(unit: ReviewUnit) -> tuple[Optional[str], str]:
+        messages = generate_initial_prompt()
+        messages.append({'role': 'user', 'content': f'Suggest a single change for the code (the part of a larger '
+                                                    f'file containing {unit.name}): {unit.text}'})
+        patch, explanation, _ = get_review_result(messages, model, limiter=rate_limiter, call_site="reviewer.unit")
+        hunks = parse_unified_diff(patch)
+        # None means no change; an empty string is a patch that deletes the whole unit.
+        return (apply_hunks(unit.text, hunks) if hunks else None), (explanation or "").strip()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Each unit runs in a copy of this context, so its usage is labelled with the file under review.
+        futures = [pool.submit(contextvars.copy_context().run, review, unit) for unit in units]
+
+    edits, explanations, errors = [], [], []
+    for unit, future in zip(units, futures):
+        try:
+            new_text, explanation = future.result()
+        except PatchError as e:
+            errors.append(f"{unit.name}: the suggested patch does not apply: {e}")
+            continue
+        except (OpenAIError, ElementTree.ParseError) as e:
+            errors.append(f"{unit.name}: review failed: {e}")
+            continue
+        if new_text is not None:
+            edits.append((unit, new_text))
+            explanations.append(f"{unit.name}: {explanation}")
+
+    improved_code, conflicts = merge_unit_edits(file_contents, edits)
+    errors.extend(f"{conflict.unit.name}: {conflict.reason}" for conflict in conflicts)
+    return UnitReview(improved_code, "\n\n".join(explanations), errors)
+
+
+def review_code(file: str, model: str, messages: list[dict], workers: int = 8) -> None:
+    # Only the current version of the file is sent. Earlier iterations stay in the history as the patches the model
+    # suggested, with the file itself left out, so the request size doesn't grow with every suggestion.
+    history: list[dict] = []
+    outcome = ""
+    rate_limiter = limiter_for(model)
+    # Each iteration reviews the current contents of the file, so long sessions run in constant stack space.
+    while True:
+        try:
+            with open(file, "r") as f:
+                file_contents = f.read()
+        except FileNotFoundError:
+            LOGGER.error(f"Unable to read the file {file}")
+            sys.exit(1)
+
+        LOGGER.info(f"Reviewing {file}")
+
+        # The explanation is printed while it streams in, ahead of the diff.
+        streamed = []
+
+        def show_explanation(text: str) -> None:
+            if not streamed:
+                print("\nAssistant: ", end="")
+            streamed.append(text)
+            print(text, end="", flush=True)
+
+        request = messages + history[-2 * MAX_HISTORY_SUGGESTIONS:] + [review_request(file_contents, outcome)]
+        prompt_tokens = num_tokens_from_messages(request, model)
+        LOGGER.debug(f"Prompt tokens: {prompt_tokens}")
+        if prompt_tokens > model_context_size(model) - REPLY_TOKEN_RESERVE:
+            LOGGER.info(f"The review request uses {prompt_tokens} tokens, which is too many for the "
+                        f"{model_context_size(model)}-token context of {model}. Reviewing the file in parts.")
+            unit_review = review_units(file_contents, model, workers, rate_limiter)
+            for error in unit_review.errors:
+                LOGGER.warning(error)
+            improved_code, explanation = unit_review.improved_code, unit_review.explanation
+            if improved_code == file_contents:
+                print(f"\nAssistant: {explanation or 'No changes were suggested.'}\n\n")
+                return
+        else:
+            patch, explanation, assistant_message = get_review_result(request, model, show_explanation, rate_limiter)
+            if streamed:
+                print("\n\n")
+            history.append(review_request("[previous version of the file omitted]", outcome))
+            history.append({'role': 'assistant', 'content': assistant_message['content']})
+
+            if not parse_unified_diff(patch):
+                if not streamed:
+                    print(f"\nAssistant: {explanation}\n\n")
+                return
+
+            try:
+                improved_code = apply_hunks(file_contents, parse_unified_diff(patch))
+            except PatchError as e:
+                LOGGER.error(f"The suggested patch does not apply to {file}: {e}")
+                outcome = "The previous patch did not apply to the file. "
+                if not check_to_continue():
+                    return
+                continue
+
+        print(generate_diff(file_contents, improved_code))
+        if not streamed:
+            print(f"\nAssistant: {explanation}\n\n")
+
+        user_decision = input("Would you like to apply this change?[Y/N]:")
+
+        outcome = "The previous change was not applied. "
+        if user_decision.upper() == 'Y':
+            try:
+                with open(file, "w") as f:
+                    f.write(improved_code)
+                outcome = "The previous change was applied. "
+            except FileNotFoundError:
+                LOGGER.error(f"Unable to write to the file: {file}")
+        elif user_decision.upper() != 'N':
+            print("Invalid input. Skipping applying the change...")
+
+        if not check_to_continue():
+            return
+
+
+@dataclass
+class FileReview:
+    file: str
+    diff: str = ""
+    explanation: str = ""
+    error: str = ""
+
+
+def collect_files(target: str, pattern: str) -> list[str]:
+    """
+    Expand a directory (searched recursively for `pattern`), a glob or a single file into a sorted list of files.
+    """
+    if os.path.isdir(target):
+        matches = glob.glob(os.path.join(target, "**", pattern), recursive=True)
     else:
-        print("Exiting the program. Good Bye!")
-        sys.exit(0)
+        matches = glob.glob(target, recursive=True)
+    return sorted(path for path in matches if os.path.isfile(path))
 
 
-def review_code(file: str, model: str, messages: list[dict]) -> None:
+def review_file(file: str, model: str, rate_limiter: RateLimiter) -> FileReview:
+    """
+    Ask for a single suggestion on a file without changing it.
+    """
     try:
         with open(file, "r") as f:
             file_contents = f.read()
-    except FileNotFoundError:
-        LOGGER.error(f"Unable to read the file {file}")
-        sys.exit(1)
-
-    LOGGER.info(f"Reviewing {file}")
+    except (OSError, UnicodeDecodeError) as e:
+        return FileReview(file, error=f"Unable to read the file: {e}")
 
+    messages = generate_initial_prompt()
     messages.append({'role': 'user', 'content': f'Suggest a single change for the code: {file_contents}'})
-    # todo: count tokens and warn
-    improved_code, explanation, assistant_message = get_review_result(messages, model)
-    messages.append(assistant_message)
+    prompt_tokens = num_tokens_from_messages(messages, model)
+    if prompt_tokens > model_context_size(model) - REPLY_TOKEN_RESERVE:
+        # Too large for one request: review it in parts, on a small pool of its own.
+        unit_review = review_units(file_contents, model, UNIT_WORKERS, rate_limiter)
+        diff = generate_diff(file_contents, unit_review.improved_code, color=False)
+        return FileReview(file, diff=diff, explanation=unit_review.explanation, error="\n".join(unit_review.errors))
 
-    if improved_code:
-        print(generate_diff(file_contents, improved_code))
-        print(f"\nAssistant: {explanation}\n\n")
-    else:
-        print(f"\nAssistant: {explanation}\n\n")
-        sys.exit(0)
+    try:
+        patch, explanation, _ = get_review_result(messages, model, limiter=rate_limiter)
+    except (OpenAIError, ElementTree.ParseError) as e:
+        return FileReview(file, error=f"Review failed: {e}")
 
-    user_decision = input("Would you like to apply this change?[Y/N]:")
+    explanation = (explanation or "").strip()
+    hunks = parse_unified_diff(patch)
+    if not hunks:
+        return FileReview(file, explanation=explanation)
+    try:
+        improved_code = apply_hunks(file_contents, hunks)
+    except PatchError as e:
+        return FileReview(file, explanation=explanation, error=f"The suggested patch does not apply: {e}")
+    return FileReview(file, diff=generate_diff(file_contents, improved_code, color=False), explanation=explanation)
 
-    if user_decision.upper() == 'Y':
-        try:
-            with open(file, "w") as f:
-                f.write(improved_code)
-        except FileNotFoundError:
-            LOGGER.error(f"Unable to write to the file: {file}")
-        check_to_continue(file, model, messages)
-    elif user_decision.upper() == 'N':
-        check_to_continue(file, model, messages)
-    else:
-        print("Invalid input. Skipping applying the change...")
-        check_to_continue(file, model, messages)
+
+def review_files(files: list[str], model: str, workers: int, max_time: Optional[float] = None) -> list[FileReview]:
+    """
+    Review many files concurrently on a bounded worker pool, keeping under the rate limits of `model` (see
+    common.client). Files that haven't started within `max_time` seconds are skipped, so the whole run finishes in
+    bounded time.
+    """
+    rate_limiter = limiter_for(model)
+    deadline = None if max_time is None else time.monotonic() + max_time
+
+    def review(file: str) -> FileReview:
+        if deadline is not None and time.monotonic() > deadline:
+            return FileReview(file, error="Skipped: the batch ran out of time")
+        with usage_labels(document=file):
+            return review_file(file, model, rate_limiter)
+
+    reviews = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Reviews run in copies of this context, so the usage meters of the caller see their requests.
+        futures = [pool.submit(contextvars.copy_context().run, review, file) for file in files]
+        for i, future in enumerate(as_completed(futures), start=1):
+            reviews.append(future.result())
+            LOGGER.info(f"Reviewed {i}/{len(files)}: {reviews[-1].file}")
+    return sorted(reviews, key=lambda review: review.file)
+
+
+def write_report(reviews: list[FileReview], report_file: str) -> None:
+    with open(report_file, "w") as f:
+        f.write("# Code Review Report\n\n")
+        changed = sum(1 for review in reviews if review.diff)
+        failed = sum(1 for review in reviews if review.error)
+        f.write(f"{len(reviews)} files reviewed, {changed} with suggested changes, {failed} failed.\n\n")
+        for review in reviews:
+            f.write(f"## {review.file}\n\n")
+            if review.error:
+                f.write(f"**Error:** {review.error}\n\n")
+            if review.explanation:
+                f.write(f"{review.explanation}\n\n")
+            if review.diff:
+                diff = review.diff.rstrip("\n")
+                f.write(f"```diff\n{diff}\n```\n\n")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Code Reviewer OpenAI API")
-    parser.add_argument("file", help="The target file to review")
+    parser.add_argument("file", help="The target file to review, or with --batch a directory or glob")
     parser.add_argument("--model", default="gpt-3.5-turbo", help="The model to use(default: gpt-3.5-turbo)")
+    parser.add_argument("--batch", action="store_true", help="Review many files non-interactively and write a report")
+    parser.add_argument("--pattern", default="*.py", help="File pattern used when --batch is given a directory")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Files (or parts of a large file) reviewed concurrently")
+    parser.add_argument("--rpm", type=float, help="Maximum requests per minute (default: the model's quota)")
+    parser.add_argument("--tpm", type=float, help="Maximum tokens per minute (default: the model's quota)")
+    parser.add_argument("--max-time", type=float, help="Stop starting new reviews after this many seconds")
+    parser.add_argument("--report", default="review_report.md", help="Where to write the batch report")
+    parser.add_argument("--usage-report", metavar="PATH",
+                        help="Write the tokens, cost and latency per model, file and call site to PATH, as JSON or, "
+                             "for a .prom file, as Prometheus metrics")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Record where the time goes and write it to PATH in the Chrome trace format")
     args = parser.parse_args()
+    if args.trace:
+        tracing.enable()
+    if args.rpm or args.tpm:
+        requests_per_minute, tokens_per_minute = default_rate_limits(args.model)
+        configure(args.model, args.rpm or requests_per_minute, args.tpm or tokens_per_minute)
 
-    try:
-        review_code(args.file, args.model, generate_initial_prompt())
-    except KeyboardInterrupt:
-        print("Good Bye!!")
+    with metering() as usage:
+        try:
+            if args.batch:
+                files = collect_files(args.file, args.pattern)
+                LOGGER.info(f"Reviewing {len(files)} files with {args.workers} workers")
+                write_report(review_files(files, args.model, args.workers, args.max_time), args.report)
+                print(f"Wrote the review report to {args.report}")
+            else:
+                with usage_labels(document=args.file):
+                    review_code(args.file, args.model, generate_initial_prompt(), args.workers)
+        except KeyboardInterrupt:
+            print("Good Bye!!")
+    LOGGER.info(f"Used {usage} (token counts of streamed reviews are estimated)")
+    if args.usage_report:
+        usage.write(args.usage_report)
+    if args.trace:
+        tracing.write_trace(args.trace)
+        LOGGER.info(f"Wrote the trace to {args.trace}\n{tracing.format_summary()}")
 
 
 if __name__ == "__main__":
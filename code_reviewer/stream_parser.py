@@ -0,0 +1,86 @@
+import xml.etree.ElementTree as ElementTree
+from typing import Callable, Optional
+from xml.sax.saxutils import unescape
+
+ROOT_START = "<root>"
+EXPLANATION_START = "<explanation>"
+EXPLANATION_END = "</explanation>"
+ALLOWED_ELEMENTS = {"root", "patch", "explanation"}
+
+
+class ReviewStreamParser:
+    """
+    Incrementally parses a streamed review response of the form <root><patch/><explanation/></root>.
+
+    Text before <root> is buffered, since models sometimes add a sentence before the XML. Once the root starts, the
+    response is fed to an XMLPullParser as it arrives, so a malformed response raises ElementTree.ParseError as soon
+    as the structure breaks instead of after the whole completion has been paid for. The explanation is passed to
+    `on_explanation` piece by piece while it streams. `done` becomes True once </root> has been read.
+    """
+
+    def __init__(self, on_explanation: Optional[Callable[[str], None]] = None):
+        self.on_explanation = on_explanation
+        self.text = ""
+        self.patch: Optional[str] = None
+        self.explanation: Optional[str] = None
+        self.done = False
+        self._parser: Optional[ElementTree.XMLPullParser] = None
+        self._root_offset = -1
+        self._explanation_emitted = -1  # offset in self.text up to which the explanation was passed on
+
+    def feed(self, data: str) -> None:
+        self.text += data
+        if self._parser is None:
+            self._root_offset = self.text.find(ROOT_START)
+            if self._root_offset == -1:
+                return
+            self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+            data = self.text[self._root_offset:]
+
+        self._parser.feed(data)
+        for event, element in self._parser.read_events():
+            if element.tag not in ALLOWED_ELEMENTS:
+                raise ElementTree.ParseError(f"unexpected element <{element.tag}> in the review response")
+            if event == "end" and element.tag == "patch":
+                self.patch = element.text or ""
+            elif event == "end" and element.tag == "explanation":
+                self.explanation = element.text or ""
+            elif event == "end" and element.tag == "root":
+                self.done = True
+        self._stream_explanation()
+
+    def _stream_explanation(self) -> None:
+        if self.on_explanation is None:
+            return
+        if self._explanation_emitted == -1:
+            start = self.text.find(EXPLANATION_START, self._root_offset)
+            if start == -1:
+                return
+            self._explanation_emitted = start + len(EXPLANATION_START)
+        end = self.text.find(EXPLANATION_END, self._explanation_emitted)
+        if end == -1:
+            # Hold back anything that could be the start of the closing tag or an unfinished entity.
+            end = len(self.text)
+            partial = max(self.text.rfind("<", self._explanation_emitted), self.text.rfind("&", self._explanation_emitted))
+            if partial != -1 and ";" not in self.text[partial:]:
+                end = partial
+        if end > self._explanation_emitted:
+            self.on_explanation(unescape(self.text[self._explanation_emitted:end]))
+            self._explanation_emitted = end
+
+    @property
+    def partial_explanation(self) -> str:
+        """
+        The explanation received so far, for responses that broke off before </explanation>.
+        """
+        if self.explanation is not None:
+            return self.explanation
+        start = self.text.find(EXPLANATION_START, max(self._root_offset, 0))
+        if start == -1:
+            return ""
+        end = self.text.find(EXPLANATION_END, start)
+        return unescape(self.text[start + len(EXPLANATION_START):end if end != -1 else len(self.text)])
+
+    @property
+    def has_xml(self) -> bool:
+        return self._parser is not None
@@ -1,41 +1,14 @@
 from typing import Dict, List
 from termcolor import colored
-import difflib
-import tiktoken
+import os
+import sys
 
-
-# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages: List[Dict], model: str) -> int:
-    """
-    Returns the number of tokens used by a list of messages.
-    """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301")
-    elif model == "gpt-4":
-        return num_tokens_from_messages(messages, model="gpt-4-0314")
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4-0314":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+# Make the shared modules in <repository_home>/common importable when running from this directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.ratelimit import RateLimiter
+from common.tokens import model_context_size, num_tokens_from_messages
+from diff_engine import DEFAULT_DIFF_ENGINE, diff_hunks
+from patch import format_hunk_header
 
 
 def generate_initial_prompt() -> List[Dict]:
@@ -44,22 +17,26 @@ def generate_initial_prompt() -> List[Dict]:
     quality. You will suggest one change and an explanation describing the changes made to the code and why the 
     change is suggested
 
-    The output should only include the improved code and the explanation of the change in the following XML format
+    The output should only include the change, as a unified diff against the given code, and the explanation of the
+    change in the following XML format. Do not repeat the unchanged parts of the code outside the diff context.
 
     <root>
-      <code><![CDATA[
-        Improved Code
-      ]]></code>
+      <patch><![CDATA[
+    @@ -start,count +start,count @@
+     context line
+    -removed line
+    +added line
+      ]]></patch>
       <explanation>
         explanation of the change and why
       </explanation>
     </root>
     
-    When there is no improvements to suggest return only an explanation in the same XML format where the code section 
-    is empty
+    When there is no improvements to suggest return only an explanation in the same XML format where the patch 
+    section is empty
     
     <root>
-      <code></code>
+      <patch></patch>
       <explanation>
         explanation that no changes are required
       </explanation>
@@ -67,31 +44,36 @@ def generate_initial_prompt() -> List[Dict]:
     """
 
     code_sample_1 = """
-    import logger
-    log = logger.get_logger(__name__)
-
-    def fibonacci(n):
-        log.info("fibonacci(" + n + ") invoked.")
-        if n <= 1:
-            log.info("fibonacci(" + n + ") returning " + n + ".")
-            return n
-        return fibonacci(n - 1) + fibonacci(n - 2)
-    """
-
-    sample_response_1 = """
-    <root>
-        <code><![CDATA[
-import logging
-
-log = logging.getLogger(__name__)
+import logger
+log = logger.get_logger(__name__)
 
 def fibonacci(n):
-    log.info(f"fibonacci({n}) invoked.")
+    log.info("fibonacci(" + n + ") invoked.")
     if n <= 1:
-        log.info(f"fibonacci({n}) returning {n}.")
+        log.info("fibonacci(" + n + ") returning " + n + ".")
         return n
     return fibonacci(n - 1) + fibonacci(n - 2)
-        ]]></code>
+    """
+
+    sample_response_1 = """
+    <root>
+        <patch><![CDATA[
+@@ -1,9 +1,10 @@
+-import logger
+-log = logger.get_logger(__name__)
++import logging
++
++log = logging.getLogger(__name__)
+ 
+ def fibonacci(n):
+-    log.info("fibonacci(" + n + ") invoked.")
++    log.info(f"fibonacci({n}) invoked.")
+     if n <= 1:
+-        log.info("fibonacci(" + n + ") returning " + n + ".")
++        log.info(f"fibonacci({n}) returning {n}.")
+         return n
+     return fibonacci(n - 1) + fibonacci(n - 2)
+        ]]></patch>
         <explanation>
             The suggested change is to use f-string formatting instead of string concatenation for the logging statements. F-strings provide a more concise and readable way to incorporate variables into strings, improving code readability and maintainability.
         </explanation>
@@ -158,20 +140,17 @@ Overall, the code is in good shape, and no additional changes are required.
     return messages
 
 
-def generate_diff(original_content: str, changed_content: str) -> str:
-    diff = difflib.unified_diff(original_content.splitlines(keepends=True), 
-                                changed_content.splitlines(keepends=True), n=3, lineterm="")
-    
+def generate_diff(original_content: str, changed_content: str, color: bool = True,
+                  engine: str = DEFAULT_DIFF_ENGINE) -> str:
     result = []
-    for line in diff:
-        if line.startswith("---") or line.startswith("+++"):
-            continue
-        elif line.startswith("-"):
-            result.append(colored(line, "red"))
-        elif line.startswith("+"):
-            result.append(colored(line, "green"))
-        elif line.startswith("@@"):
-            result.append(colored(line, "cyan"))
-        else:
-            result.append(line)
-    return "".join(result)
\ No newline at end of file
+    for hunk in diff_hunks(original_content, changed_content, context=3, engine=engine):
+        header = format_hunk_header(hunk)
+        result.append(colored(header, "cyan") + "\n" if color else header + "\n")
+        for line in hunk.lines:
+            if color and line.startswith("-"):
+                result.append(colored(line, "red") + "\n")
+            elif color and line.startswith("+"):
+                result.append(colored(line, "green") + "\n")
+            else:
+                result.append(line + "\n")
+    return "".join(result)
@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+# Enforce max_entries every this many writes, so eviction doesn't count the table on every insert.
+EVICTION_INTERVAL = 64
+
+
+class PersistentCache:
+    """
+    A key-value cache stored in SQLite in WAL mode.
+
+    Writes are single-row inserts, so their cost doesn't grow with the size of the cache, and several processes can
+    read and write the same file at once. Nothing is loaded up front; the database is opened on first use and each
+    lookup reads a single row. Entries older than `max_age` seconds are treated as misses and removed, and the least
+    recently used entries are removed once there are more than `max_entries`.
+    """
+
+    def __init__(self, path: str, max_entries: Optional[int] = None, max_age: Optional[float] = None,
+                 timeout: float = 30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.timeout = timeout
+        # sqlite3 connections can't be shared between threads, so each thread lazily opens its own.
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str, default: Any = None) -> Any:
+        connection = self._connection()
+        row = connection.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        value, created_at = row
+        now = time.time()
+        if self.max_age is not None and now - created_at > self.max_age:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return default
+        if self.max_entries is not None:
+            # Only the LRU eviction needs access times, so skip the write otherwise.
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def __contains__(self, key: str) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now, now),
+        )
+        with self._writes_lock:
+            self._writes += 1
+            evict = self._writes % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove expired entries, then the least recently used ones beyond max_entries.
+        """
+        connection = self._connection()
+        if self.max_age is not None:
+            connection.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            connection.execute(
+                "DELETE FROM entries WHERE key IN "
+                "(SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def import_json(self, json_file: str) -> int:
+        """
+        Copy the entries of a JSON cache file (the format memoize_to_file used to write) into this cache, without
+        overwriting existing keys. Returns the number of entries read.
+        """
+        if not os.path.exists(json_file):
+            return 0
+        with open(json_file, "r") as f:
+            entries = json.load(f)
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT OR IGNORE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                ((key, json.dumps(value), now, now) for key, value in entries.items()),
+            )
+        return len(entries)
@@ -0,0 +1,239 @@
+"""
+Shared layer for calls to the OpenAI API: per-model rate limiting and one retry policy for every tool.
+
+Every request reserves its estimated tokens (counted with tiktoken) from the rate limiter of its model before it is
+sent, so concurrent callers in the same process stay under the requests- and tokens-per-minute quotas instead of
+finding them with 429s. Failed calls are retried with jittered exponential backoff; when the API sends Retry-After, the
+whole limiter is paused for that long, so the other callers back off too. chat_completion records the tokens and
+latency of each call in common.usage.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, Sequence, Tuple, TypeVar
+
+import openai
+from openai.error import (APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout,
+                          TryAgain)
+
+from common.ratelimit import RateLimiter
+from common.tokens import MODEL_ALIASES, count_tokens_batch, num_tokens_from_messages
+from common.tracing import span
+from common.usage import record_response
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Default quotas, as (requests per minute, tokens per minute), keyed by model. Override them with configure(), or for
+# every model with the OPENAI_RPM and OPENAI_TPM environment variables.
+MODEL_RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo-0301": (3500, 90_000),
+    "gpt-4-0314": (200, 40_000),
+    "text-embedding-ada-002": (3000, 1_000_000),
+}
+DEFAULT_RATE_LIMITS = (3500, 90_000)
+# Requests in flight at once per model, across all threads.
+DEFAULT_MAX_CONCURRENT = 16
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+# Completion tokens reserved for a chat request that doesn't set max_tokens. The reservation is corrected with the
+# actual usage when the response reports it.
+EXPECTED_COMPLETION_TOKENS = 500
+
+RETRYABLE_ERRORS = (APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain)
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _model_key(model: str) -> str:
+    return MODEL_ALIASES.get(model, model)
+
+
+def default_rate_limits(model: str) -> Tuple[float, float]:
+    """
+    The (requests per minute, tokens per minute) quotas assumed for a model unless configure() says otherwise.
+    """
+    requests_per_minute, tokens_per_minute = MODEL_RATE_LIMITS.get(_model_key(model), DEFAULT_RATE_LIMITS)
+    return (float(os.environ.get("OPENAI_RPM", requests_per_minute)),
+            float(os.environ.get("OPENAI_TPM", tokens_per_minute)))
+
+
+def configure(model: str, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+              max_concurrent: Optional[int] = DEFAULT_MAX_CONCURRENT) -> RateLimiter:
+    """
+    Replace the shared limiter of a model, for example with the quotas of your account. A quota left as None is not
+    limited.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrent)
+    with _limiters_lock:
+        _limiters[_model_key(model)] = limiter
+    return limiter
+
+
+def limiter_for(model: str) -> RateLimiter:
+    """
+    The limiter shared by every caller of a model in this process.
+    """
+    key = _model_key(model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(*default_rate_limits(model), DEFAULT_MAX_CONCURRENT)
+            _limiters[key] = limiter
+        return limiter
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Seconds the API asked to wait before retrying, from the Retry-After header of an error response, if any.
+    """
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    # Full jitter: concurrent callers that failed together don't retry together.
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, RateLimitError) and error.code == "insufficient_quota":
+        # Out of credit; retrying won't help.
+        return False
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def call_with_retries(request: Callable[[], T], limiter: RateLimiter, tokens: int = 0,
+                      max_attempts: int = MAX_ATTEMPTS, retry_on: Tuple[type, ...] = (),
+                      on_retry: Optional[Callable[[Exception, int], None]] = None) -> T:
+    """
+    Run `request` in a slot of `limiter` with `tokens` reserved, retrying transient API errors and any exception in
+    `retry_on` up to max_attempts times. The last error is raised when the attempts run out.
+    """
+    for attempt in itertools.count(1):
+        with limiter.slot(tokens):
+            try:
+                return request()
+            except Exception as e:
+                if not (is_retryable(e) or isinstance(e, retry_on)) or attempt >= max_attempts:
+                    raise
+                error = e
+        delay = _before_retry(error, attempt, max_attempts, limiter, on_retry)
+        if delay:
+            with span("retry.backoff", attempt=attempt):
+                time.sleep(delay)
+
+
+async def acall_with_retries(request: Callable[[], Awaitable[T]], limiter: RateLimiter, tokens: int = 0,
+                             max_attempts: int = MAX_ATTEMPTS, retry_on: Tuple[type, ...] = (),
+                             on_retry: Optional[Callable[[Exception, int], None]] = None) -> T:
+    """
+    call_with_retries for a coroutine function, waiting on the limiter without blocking the event loop.
+    """
+    for attempt in itertools.count(1):
+        async with limiter.aslot(tokens):
+            try:
+                return await request()
+            except Exception as e:
+                if not (is_retryable(e) or isinstance(e, retry_on)) or attempt >= max_attempts:
+                    raise
+                error = e
+        delay = _before_retry(error, attempt, max_attempts, limiter, on_retry)
+        if delay:
+            with span("retry.backoff", attempt=attempt):
+                await asyncio.sleep(delay)
+
+
+def _before_retry(error: Exception, attempt: int, max_attempts: int, limiter: RateLimiter,
+                  on_retry: Optional[Callable[[Exception, int], None]]) -> float:
+    # Log and report a failed attempt, and return how long the caller should sleep before the next one.
+    requested_delay = retry_after(error)
+    delay = backoff_delay(attempt) if requested_delay is None else requested_delay
+    LOGGER.warning(f"Request failed (try {attempt} of {max_attempts}), retrying in {delay:.1f}s. {error}")
+    if on_retry is not None:
+        on_retry(error, attempt)
+    if requested_delay is None:
+        return delay
+    # Every caller of the limiter waits, not just this one. The next slot starts after the pause.
+    limiter.pause(requested_delay)
+    return 0.0
+
+
+def estimate_chat_tokens(messages: Sequence[Dict], model: str, max_tokens: Optional[int] = None) -> int:
+    """
+    Tokens a chat request counts against the quota: its prompt plus the completion it may generate.
+    """
+    try:
+        prompt_tokens = num_tokens_from_messages(messages, model)
+    except NotImplementedError:
+        prompt_tokens = sum(count_tokens_batch([str(message.get("content", "")) for message in messages], model))
+    return prompt_tokens + (max_tokens or EXPECTED_COMPLETION_TOKENS)
+
+
+def chat_completion(messages: Sequence[Dict], model: str, limiter: Optional[RateLimiter] = None,
+                    max_attempts: int = MAX_ATTEMPTS, call_site: Optional[str] = None, **kwargs):
+    """
+    openai.ChatCompletion.create through the shared limiter of `model`, with retries, recording its usage under
+    `call_site` (see common.usage). Not for streamed requests, which have to be retried around the code that reads
+    the stream (see call_with_retries).
+    """
+    limiter = limiter or limiter_for(model)
+    estimate = estimate_chat_tokens(messages, model, kwargs.get("max_tokens"))
+
+    def request():
+        start = time.perf_counter()
+        with span("request", model=model, call_site=call_site):
+            response = openai.ChatCompletion.create(model=model, messages=messages, **kwargs)
+        record_response(response, model, time.perf_counter() - start, call_site)
+        usage = response.get("usage")
+        if usage:
+            limiter.adjust(usage["total_tokens"] - estimate)
+        return response
+
+    return call_with_retries(request, limiter, estimate, max_attempts)
+
+
+async def achat_completion(messages: Sequence[Dict], model: str, limiter: Optional[RateLimiter] = None,
+                           max_attempts: int = MAX_ATTEMPTS, call_site: Optional[str] = None, **kwargs):
+    """
+    chat_completion with openai.ChatCompletion.acreate, for coroutines.
+    """
+    limiter = limiter or limiter_for(model)
+    estimate = estimate_chat_tokens(messages, model, kwargs.get("max_tokens"))
+
+    async def request():
+        start = time.perf_counter()
+        with span("request", model=model, call_site=call_site):
+            response = await openai.ChatCompletion.acreate(model=model, messages=messages, **kwargs)
+        record_response(response, model, time.perf_counter() - start, call_site)
+        usage = response.get("usage")
+        if usage:
+            limiter.adjust(usage["total_tokens"] - estimate)
+        return response
+
+    return await acall_with_retries(request, limiter, estimate, max_attempts)
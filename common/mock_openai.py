@@ -0,0 +1,285 @@
+"""
+A local stand-in for the OpenAI chat completion and embedding APIs, for exercising the tools without the live service.
+
+Run it with `python -m common.mock_openai --port 8081` from the repository root and point the client at it with
+`openai.api_base = "http://127.0.0.1:8081/v1"`. Latency, token rate and injected errors are set with MockConfig, and
+the tokens served are counted in MockUsage, which is also available at GET /mock/usage (DELETE resets it).
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+
+WORDS = ("the quick brown fox jumps over the lazy dog while a curious assistant explains what it "
+         "is doing and why").split()
+ERROR_KINDS = ("rate_limit", "connection")
+
+
+@dataclass
+class MockConfig:
+    # Seconds before the first token of a response is sent.
+    first_token_latency: float = 0.2
+    # Tokens (words) sent per second once a response has started.
+    tokens_per_second: float = 50.0
+    # Number of tokens (words) in each reply.
+    reply_tokens: int = 40
+    # Fixed text to reply with instead, sent a word at a time along with the whitespace before it.
+    reply_text: Optional[str] = None
+    # Seconds before an embedding response is sent, plus the time to process its input at the rate below.
+    embedding_latency: float = 0.1
+    embedding_tokens_per_second: float = 200_000.0
+    embedding_dim: int = 1536
+    # Requests with more inputs than this are rejected, like the live API does.
+    max_embedding_inputs: int = 2048
+    # Fraction of requests that fail with one of error_kinds: "rate_limit" answers 429 with a Retry-After header
+    # (RateLimitError in the client) and "connection" drops the connection (APIConnectionError).
+    error_rate: float = 0.0
+    error_kinds: Tuple[str, ...] = ERROR_KINDS
+    retry_after: float = 1.0
+
+
+@dataclass
+class MockUsage:
+    requests: int = 0
+    rate_limit_errors: int = 0
+    connection_errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def reply_words(count: int):
+    return [WORDS[i % len(WORDS)] for i in range(count)]
+
+
+def reply_chunks(config: MockConfig) -> List[str]:
+    """
+    The content deltas of a reply, one token (word) each.
+    """
+    if config.reply_text is not None:
+        return re.findall(r"\s*\S+", config.reply_text) or [config.reply_text]
+    return [word if i == 0 else f" {word}" for i, word in enumerate(reply_words(config.reply_tokens))]
+
+
+def injected_error(request: web.Request) -> Optional[web.Response]:
+    """
+    Count the request and, for a fraction `error_rate` of them, fail it. Returns the error response to send, if any.
+    """
+    config: MockConfig = request.app["config"]
+    usage: MockUsage = request.app["usage"]
+    usage.requests += 1
+    if not config.error_kinds or random.random() >= config.error_rate:
+        return None
+    if random.choice(config.error_kinds) == "connection":
+        usage.connection_errors += 1
+        request.transport.close()
+        return web.Response(status=500)
+    usage.rate_limit_errors += 1
+    return web.json_response({"error": {
+        "message": "Rate limit reached for requests. Please try again in a moment.",
+        "type": "requests",
+        "param": None,
+        "code": None,
+    }}, status=429, headers={"Retry-After": f"{config.retry_after:g}"})
+
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    config: MockConfig = request.app["config"]
+    usage: MockUsage = request.app["usage"]
+    body = await request.json()
+    error = injected_error(request)
+    if error is not None:
+        return error
+
+    model = body.get("model", "gpt-3.5-turbo")
+    prompt_tokens = sum(len(str(message.get("content", "")).split()) + 4 for message in body.get("messages", []))
+    usage.prompt_tokens += prompt_tokens
+    chunks = reply_chunks(config)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    await asyncio.sleep(config.first_token_latency)
+
+    if not body.get("stream"):
+        await asyncio.sleep(len(chunks) / config.tokens_per_second)
+        usage.completion_tokens += len(chunks)
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(chunks)},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(chunks),
+                "total_tokens": prompt_tokens + len(chunks),
+            },
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    async def send(delta, finish_reason=None):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+    try:
+        await send({"role": "assistant"})
+        for i, content in enumerate(chunks):
+            if i:
+                await asyncio.sleep(1 / config.tokens_per_second)
+            await send({"content": content})
+            usage.completion_tokens += 1
+        await send({}, finish_reason="stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+    except ConnectionResetError:
+        # The client stopped reading, as the chatbot does when a reply is cancelled.
+        pass
+    return response
+
+
+def mock_embedding(text: str, dim: int):
+    # The same text always gets the same vector, so results can be compared between runs.
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rng.uniform(-1.0, 1.0) for _ in range(dim)]
+
+
+async def embeddings(request: web.Request) -> web.Response:
+    config: MockConfig = request.app["config"]
+    usage: MockUsage = request.app["usage"]
+    body = await request.json()
+    error = injected_error(request)
+    if error is not None:
+        return error
+
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if len(inputs) > config.max_embedding_inputs:
+        return web.json_response({"error": {
+            "message": f"Too many inputs. The max number of inputs is {config.max_embedding_inputs}.",
+            "type": "invalid_request_error",
+            "param": None,
+            "code": None,
+        }}, status=400)
+
+    prompt_tokens = sum(len(str(text).split()) for text in inputs)
+    await asyncio.sleep(config.embedding_latency + prompt_tokens / config.embedding_tokens_per_second)
+    usage.prompt_tokens += prompt_tokens
+
+    data = []
+    for i, text in enumerate(inputs):
+        embedding = mock_embedding(str(text), config.embedding_dim)
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode("ascii")
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+    return web.json_response({
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "text-embedding-ada-002"),
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    })
+
+
+async def get_usage(request: web.Request) -> web.Response:
+    return web.json_response(request.app["usage"].to_dict())
+
+
+async def reset_usage(request: web.Request) -> web.Response:
+    usage: MockUsage = request.app["usage"]
+    usage.__init__()
+    return web.json_response(usage.to_dict())
+
+
+def create_app(config: MockConfig = None) -> web.Application:
+    app = web.Application()
+    app["config"] = config or MockConfig()
+    app["usage"] = MockUsage()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_get("/mock/usage", get_usage)
+    app.router.add_delete("/mock/usage", reset_usage)
+    return app
+
+
+def start_in_thread(config: MockConfig = None) -> Tuple[str, web.Application]:
+    """
+    Serve the mock on a free local port from an event loop in a daemon thread, for use by synchronous code. Returns
+    the API base URL and the app, whose "usage" counts what was served.
+    """
+    app = create_app(config)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    address = []
+
+    async def start():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        address.extend(runner.addresses[0][:2])
+        started.set()
+
+    def run():
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return f"http://{address[0]}:{address[1]}/v1", app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--first-token-latency", type=float, default=MockConfig.first_token_latency)
+    parser.add_argument("--tokens-per-second", type=float, default=MockConfig.tokens_per_second)
+    parser.add_argument("--reply-tokens", type=int, default=MockConfig.reply_tokens)
+    parser.add_argument("--embedding-latency", type=float, default=MockConfig.embedding_latency)
+    parser.add_argument("--embedding-dim", type=int, default=MockConfig.embedding_dim)
+    parser.add_argument("--error-rate", type=float, default=MockConfig.error_rate,
+                        help="Fraction of requests that fail")
+    parser.add_argument("--error-kinds", nargs="+", choices=ERROR_KINDS, default=list(ERROR_KINDS))
+    parser.add_argument("--retry-after", type=float, default=MockConfig.retry_after,
+                        help="Seconds sent in the Retry-After header of rate limit errors")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        embedding_latency=args.embedding_latency,
+        embedding_dim=args.embedding_dim,
+        error_rate=args.error_rate,
+        error_kinds=tuple(args.error_kinds),
+        retry_after=args.retry_after,
+    )
+    web.run_app(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
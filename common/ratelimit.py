@@ -0,0 +1,139 @@
+import asyncio
+import contextlib
+import threading
+import time
+from typing import AsyncIterator, Iterator, Optional
+
+from common.tracing import span
+
+# Quotas are enforced over windows shorter than a minute, so a full bucket holds this many seconds' worth of quota
+# rather than a whole minute's.
+BURST_SECONDS = 10.0
+# How often a coroutine waiting for a concurrent slot checks whether one is free. The slots are shared with threads,
+# so there is nothing to await on.
+SLOT_POLL_SECONDS = 0.01
+
+
+class TokenBucket:
+    """
+    A bucket that refills at `per_minute / 60` units per second, holding at most BURST_SECONDS of refill (and never
+    less than one unit). Not thread-safe on its own; RateLimiter serializes access.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Take `amount` from the bucket and return how many seconds from `now` the caller has to wait before using it.
+        The level may go negative; callers that reserve later wait for the debt to be paid back first.
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request larger than the whole bucket would never fit; let it through once the bucket is full.
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Keeps callers under a requests-per-minute and a tokens-per-minute quota, with at most `max_concurrent` calls in
+    flight. Safe to share between threads.
+
+    Each call reserves one request and its estimated tokens up front and sleeps until both quotas allow it, so a
+    burst of callers is spread out instead of all of them hitting the API and getting 429s. `pause` holds every caller
+    back, for when the API asks to retry after a delay. Either quota may be None to leave it unlimited. Coroutines use
+    aslot, which shares the quotas and slots with threads but doesn't block the event loop.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_concurrent: Optional[int] = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._concurrency = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: float) -> float:
+        # Reserve one request and `tokens` tokens, and return how long to wait before using them.
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._paused_until - now)
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens is not None and tokens:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+        return delay
+
+    def wait(self, tokens: float = 0) -> None:
+        """
+        Block until a request of `tokens` tokens may start.
+        """
+        delay = self._reserve(tokens)
+        if delay:
+            with span("ratelimit.wait", seconds=round(delay, 3)):
+                time.sleep(delay)
+
+    @contextlib.contextmanager
+    def slot(self, tokens: float = 0) -> Iterator[None]:
+        """
+        Wait for the quotas, then hold one of the concurrent slots while the block runs.
+        """
+        self.wait(tokens)
+        if self._concurrency is None:
+            yield
+            return
+        if not self._concurrency.acquire(blocking=False):
+            with span("ratelimit.slot"):
+                self._concurrency.acquire()
+        try:
+            yield
+        finally:
+            self._concurrency.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, tokens: float = 0) -> AsyncIterator[None]:
+        """
+        slot() for coroutines.
+        """
+        delay = self._reserve(tokens)
+        if delay:
+            with span("ratelimit.wait", seconds=round(delay, 3)):
+                await asyncio.sleep(delay)
+        if self._concurrency is None:
+            yield
+            return
+        if not self._concurrency.acquire(blocking=False):
+            with span("ratelimit.slot"):
+                while not self._concurrency.acquire(blocking=False):
+                    await asyncio.sleep(SLOT_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            self._concurrency.release()
+
+    def adjust(self, tokens: float) -> None:
+        """
+        Correct an earlier estimate once the actual usage is known: positive values take more tokens from the
+        quota, negative values give them back.
+        """
+        if self.tokens is None or not tokens:
+            return
+        with self._lock:
+            if tokens > 0:
+                self.tokens.reserve(tokens, time.monotonic())
+            else:
+                self.tokens.refund(-tokens)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back every caller for `seconds` from now.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
@@ -0,0 +1,152 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+import tiktoken
+
+from common.tracing import span
+
+# Number of (encoding, text) -> token count entries kept in memory.
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+# Per-message overhead of the chat format, keyed by model. Aliases point at the snapshot they currently resolve to.
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+MESSAGE_TOKEN_OVERHEAD: Dict[str, Tuple[int, int]] = {
+    # model: (tokens_per_message, tokens_per_name)
+    "gpt-3.5-turbo-0301": (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+    "gpt-4-0314": (3, 1),
+}
+MODEL_ALIASES = {
+    "gpt-3.5-turbo": "gpt-3.5-turbo-0301",
+    "gpt-4": "gpt-4-0314",
+}
+# Context window of each model, shared between the prompt and the completion.
+MODEL_CONTEXT_SIZES = {
+    "gpt-3.5-turbo-0301": 4097,
+    "gpt-4-0314": 8192,
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tokenizer for a model. Loading an encoding is expensive, so each one is built once per process.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class _TokenCountCache:
+    """
+    A thread-safe LRU map of (encoding name, text) to token count.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._counts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+            return count
+
+    def put(self, key, count: int) -> None:
+        with self._lock:
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+
+_token_counts = _TokenCountCache(TOKEN_COUNT_CACHE_SIZE)
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Returns the number of tokens in a string. Counts of recently seen strings are served from an LRU cache.
+    """
+    encoding = get_encoding(model)
+    key = (encoding.name, text)
+    count = _token_counts.get(key)
+    if count is None:
+        with span("tokenize", chars=len(text)):
+            count = len(encoding.encode(text))
+        _token_counts.put(key, count)
+    return count
+
+
+def count_tokens_batch(texts: List[str], model: str) -> List[int]:
+    """
+    Returns the number of tokens in each string. Strings missing from the cache are encoded together in one
+    `encode_batch` call, which tiktoken spreads over a thread pool.
+    """
+    encoding = get_encoding(model)
+    counts = [_token_counts.get((encoding.name, text)) for text in texts]
+    missing = list({text: None for text, count in zip(texts, counts) if count is None})
+    if missing:
+        with span("tokenize.batch", texts=len(missing)):
+            encoded = dict(zip(missing, (len(tokens) for tokens in encoding.encode_batch(missing))))
+        for text, count in encoded.items():
+            _token_counts.put((encoding.name, text), count)
+        counts = [encoded[text] if count is None else count for text, count in zip(texts, counts)]
+    return counts
+
+
+def message_token_overhead(model: str) -> Tuple[int, int]:
+    """
+    Returns (tokens_per_message, tokens_per_name) for a chat model.
+    """
+    try:
+        return MESSAGE_TOKEN_OVERHEAD[MODEL_ALIASES.get(model, model)]
+    except KeyError:
+        raise NotImplementedError(
+            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
+        )
+
+
+def model_context_size(model: str) -> int:
+    """
+    Returns the context window of a chat model, in tokens.
+    """
+    return MODEL_CONTEXT_SIZES[MODEL_ALIASES.get(model, model)]
+
+
+def num_tokens_from_messages(messages: Iterable[Dict], model: str) -> int:
+    """
+    Returns the number of tokens used by a list of messages.
+    """
+    return num_tokens_from_message_batches([messages], model)[0]
+
+
+def num_tokens_from_message_batches(batches: Iterable[Iterable[Dict]], model: str) -> List[int]:
+    """
+    Returns the number of tokens used by each list of messages. Every string across all of the lists is counted in
+    a single batch, so this is the cheap way to size many requests at once.
+    """
+    tokens_per_message, tokens_per_name = message_token_overhead(model)
+    batches = [list(messages) for messages in batches]
+    texts = [value for messages in batches for message in messages for value in message.values()]
+    counts = iter(count_tokens_batch(texts, model))
+
+    totals = []
+    for messages in batches:
+        num_tokens = 0
+        for message in messages:
+            num_tokens += tokens_per_message
+            for key in message:
+                num_tokens += next(counts)
+                if key == "name":
+                    num_tokens += tokens_per_name
+        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        totals.append(num_tokens)
+    return totals
@@ -0,0 +1,170 @@
+"""
+Lightweight tracing of where the tools spend their time: tokenizing, chunking, cache lookups and writes, waiting on
+the rate limiter, sending requests and reading streamed responses.
+
+Code marks the work with `with span("name", key=value):`, and points in time (such as the first byte of a streamed
+response) with instant(). Tracing is off by default; span() then returns a shared no-op context manager, so an
+instrumented hot path costs one function call. enable() starts recording and write_trace() saves the events in the
+Chrome trace format, which chrome://tracing and https://ui.perfetto.dev open as a timeline with one row per thread
+(and per asyncio task).
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# Events kept at most, so a long traced run can't run out of memory. Later events are counted and dropped.
+MAX_EVENTS = 1_000_000
+
+_enabled = False
+_origin_ns = 0
+_events: List[Dict] = []
+_dropped = 0
+# Row id -> name, for the rows of the timeline: threads, and the asyncio tasks running on them.
+_rows: Dict[int, str] = {}
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable() -> None:
+    """
+    Start recording, discarding the events of any earlier recording.
+    """
+    global _enabled, _origin_ns, _dropped
+    with _lock:
+        _events.clear()
+        _rows.clear()
+        _dropped = 0
+        _origin_ns = time.perf_counter_ns()
+        _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def _row() -> int:
+    """
+    The timeline row of the caller: its asyncio task if one is running, else its thread. Tasks interleave on one
+    thread, so giving each its own row keeps their spans properly nested.
+    """
+    asyncio = sys.modules.get("asyncio")
+    task = None
+    if asyncio is not None:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            pass
+    if task is not None:
+        row = id(task)
+        if row not in _rows:
+            _rows[row] = f"{threading.current_thread().name} / {task.get_name()}"
+    else:
+        row = threading.get_ident()
+        if row not in _rows:
+            _rows[row] = threading.current_thread().name
+    return row
+
+
+def _record(event: Dict) -> None:
+    global _dropped
+    if len(_events) >= MAX_EVENTS:
+        _dropped += 1
+        return
+    # list.append is atomic, so recording takes no lock.
+    _events.append(event)
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: Dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _record({"name": self.name, "cat": self.name.split(".", 1)[0], "ph": "X", "pid": os.getpid(), "tid": _row(),
+                 "ts": (self.start - _origin_ns) / 1000, "dur": (end - self.start) / 1000, "args": self.args})
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **args):
+    """
+    A context manager timing the block as the span `name`, with `args` shown alongside it. Names are dotted, and the
+    part before the first dot is the category (e.g. "cache.get" is in "cache").
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name, args)
+
+
+def instant(name: str, **args) -> None:
+    """
+    Mark a point in time, such as the first byte of a response.
+    """
+    if not _enabled:
+        return
+    _record({"name": name, "cat": name.split(".", 1)[0], "ph": "i", "s": "t", "pid": os.getpid(), "tid": _row(),
+             "ts": (time.perf_counter_ns() - _origin_ns) / 1000, "args": args})
+
+
+def summary() -> Dict[str, Tuple[int, float]]:
+    """
+    The number of spans and their total duration in seconds, by name, slowest first. Spans nested in another one
+    count towards both.
+    """
+    totals: Dict[str, List] = defaultdict(lambda: [0, 0.0])
+    for event in list(_events):
+        if event["ph"] == "X":
+            totals[event["name"]][0] += 1
+            totals[event["name"]][1] += event["dur"] / 1e6
+    return {name: (count, seconds) for name, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])}
+
+
+def format_summary(limit: Optional[int] = 15) -> str:
+    lines = [f"{'Span':<28} {'Count':>8} {'Total s':>10} {'Mean ms':>10}"]
+    for name, (count, seconds) in list(summary().items())[:limit]:
+        lines.append(f"{name:<28} {count:>8} {seconds:>10.3f} {seconds / count * 1000:>10.3f}")
+    if _dropped:
+        lines.append(f"({_dropped} events dropped after the first {MAX_EVENTS})")
+    return "\n".join(lines)
+
+
+def write_trace(path: str) -> None:
+    """
+    Save the events recorded so far in the Chrome trace format.
+    """
+    pid = os.getpid()
+    rows = [
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": row, "args": {"name": name}}
+        for row, name in list(_rows.items())
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": rows + list(_events), "displayTimeUnit": "ms",
+                   "otherData": {"dropped_events": _dropped}}, f)
@@ -0,0 +1,216 @@
+"""
+Token usage, cost and latency accounting for calls to the OpenAI API.
+
+Every call is recorded with its model and two labels taken from the context it runs in: the document it works on
+and its call site (see usage_labels). Records go to the process-wide PROCESS_METER and to every meter activated with
+metering() in the calling context, so a run can account for its own calls, and a batch for each of its documents,
+while other work goes on in the same process. Labels and meters are context variables: they follow asyncio tasks on
+their own, and threads when the task is submitted in a copy of the context (contextvars.copy_context().run).
+
+A meter reports its totals grouped by any of the labels, as JSON (report) or in the Prometheus text format
+(prometheus).
+"""
+import contextlib
+import json
+import threading
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from common.tokens import MODEL_ALIASES
+
+# Dollars per 1000 prompt and completion tokens, as of Q2 2023. Models missing here are counted as free.
+PRICES_PER_1K_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo-0301": (0.002, 0.002),
+    "gpt-4-0314": (0.03, 0.06),
+    "text-embedding-ada-002": (0.0004, 0.0),
+}
+
+LABELS = ("model", "document", "call_site")
+
+
+class UsageKey(NamedTuple):
+    model: str
+    document: str
+    call_site: str
+
+
+@dataclass
+class Usage:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Requests whose tokens were counted locally because the response didn't report them (streamed completions).
+    estimated_requests: int = 0
+    latency_seconds: float = 0.0
+    cost: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "Usage") -> None:
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.estimated_requests += other.estimated_requests
+        self.latency_seconds += other.latency_seconds
+        self.cost += other.cost
+
+
+def usage_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = PRICES_PER_1K_TOKENS.get(MODEL_ALIASES.get(model, model), (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class UsageMeter:
+    """
+    Usage totals per (model, document, call site). Safe to record into from any number of threads.
+    """
+
+    def __init__(self):
+        self._usage: Dict[UsageKey, Usage] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: UsageKey, usage: Usage) -> None:
+        with self._lock:
+            self._usage.setdefault(key, Usage()).add(usage)
+
+    def totals(self, by: Sequence[str] = (), **where: str) -> Dict[tuple, Usage]:
+        """
+        Usage summed over the records matching `where` (e.g. document="peter-pan"), grouped by the labels in `by`.
+        """
+        with self._lock:
+            items = [(key, Usage(**asdict(usage))) for key, usage in self._usage.items()]
+        groups: Dict[tuple, Usage] = {}
+        for key, usage in items:
+            if all(getattr(key, label) == value for label, value in where.items()):
+                groups.setdefault(tuple(getattr(key, label) for label in by), Usage()).add(usage)
+        return groups
+
+    def total(self, **where: str) -> Usage:
+        return self.totals((), **where).get((), Usage())
+
+    def report(self) -> Dict:
+        """
+        The totals overall and per label, and every (model, document, call site) row, as JSON-serializable data.
+        """
+        def summary(usage: Usage) -> Dict:
+            return {**asdict(usage), "total_tokens": usage.total_tokens, "cost": round(usage.cost, 6)}
+
+        return {
+            "total": summary(self.total()),
+            **{
+                f"by_{label}": {key[0]: summary(usage) for key, usage in sorted(self.totals([label]).items())}
+                for label in LABELS
+            },
+            "rows": [
+                {**dict(zip(LABELS, key)), **summary(usage)} for key, usage in sorted(self.totals(LABELS).items())
+            ],
+        }
+
+    def prometheus(self, prefix: str = "openai") -> str:
+        """
+        The totals in the Prometheus text exposition format, one series per (model, document, call site).
+        """
+        rows = sorted(self.totals(LABELS).items())
+        metrics = [
+            ("requests_total", "counter", "Requests that completed.", lambda usage: usage.requests),
+            ("prompt_tokens_total", "counter", "Prompt tokens used.", lambda usage: usage.prompt_tokens),
+            ("completion_tokens_total", "counter", "Completion tokens used.", lambda usage: usage.completion_tokens),
+            ("estimated_requests_total", "counter", "Requests whose tokens were counted locally.",
+             lambda usage: usage.estimated_requests),
+            ("cost_dollars_total", "counter", "Cost at list prices, in dollars.", lambda usage: usage.cost),
+        ]
+        lines: List[str] = []
+        for name, kind, help_text, value in metrics:
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} {kind}"]
+            lines += [f"{prefix}_{name}{{{_label_pairs(key)}}} {value(usage):g}" for key, usage in rows]
+        name = f"{prefix}_request_duration_seconds"
+        lines += [f"# HELP {name} Time from sending a request to the end of its response.", f"# TYPE {name} summary"]
+        for key, usage in rows:
+            lines.append(f"{name}_sum{{{_label_pairs(key)}}} {usage.latency_seconds:g}")
+            lines.append(f"{name}_count{{{_label_pairs(key)}}} {usage.requests}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Write the report to `path`: in the Prometheus text format if it ends in .prom, else as JSON.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
+
+    def __str__(self) -> str:
+        usage = self.total()
+        return (f"{usage.requests} requests, {usage.prompt_tokens} prompt + {usage.completion_tokens} completion "
+                f"tokens, about ${usage.cost:.2f}")
+
+
+def _label_pairs(key: UsageKey) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return ",".join(f'{label}="{escape(value)}"' for label, value in zip(LABELS, key))
+
+
+# Every call made in this process.
+PROCESS_METER = UsageMeter()
+
+_meters: ContextVar[Tuple[UsageMeter, ...]] = ContextVar("usage_meters", default=())
+_document: ContextVar[str] = ContextVar("usage_document", default="")
+_call_site: ContextVar[str] = ContextVar("usage_call_site", default="")
+
+
+@contextlib.contextmanager
+def metering(meter: Optional[UsageMeter] = None) -> Iterator[UsageMeter]:
+    """
+    Also record the calls made in this context, until the block exits, into `meter` (a new one by default).
+    """
+    meter = meter if meter is not None else UsageMeter()
+    token = _meters.set(_meters.get() + (meter,))
+    try:
+        yield meter
+    finally:
+        _meters.reset(token)
+
+
+@contextlib.contextmanager
+def usage_labels(document: Optional[str] = None, call_site: Optional[str] = None) -> Iterator[None]:
+    """
+    Label the calls made in this context with a document and/or a call site. Labels left as None are inherited.
+    """
+    tokens = []
+    if document is not None:
+        tokens.append((_document, _document.set(document)))
+    if call_site is not None:
+        tokens.append((_call_site, _call_site.set(call_site)))
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+
+def record_usage(model: str, prompt_tokens: int, completion_tokens: int, latency: float, estimated: bool = False,
+                 call_site: Optional[str] = None) -> None:
+    """
+    Record one call. `call_site`, if given, overrides the one from the context.
+    """
+    key = UsageKey(model, _document.get(), call_site if call_site is not None else _call_site.get())
+    usage = Usage(1, prompt_tokens, completion_tokens, int(estimated), latency,
+                  usage_cost(model, prompt_tokens, completion_tokens))
+    PROCESS_METER.record(key, usage)
+    for meter in _meters.get():
+        meter.record(key, usage)
+
+
+def record_response(response, model: str, latency: float, call_site: Optional[str] = None) -> None:
+    """
+    Record a call from the usage its response reports. Responses without usage count as a request with no tokens.
+    """
+    usage = response.get("usage") or {}
+    record_usage(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), latency,
+                 call_site=call_site)
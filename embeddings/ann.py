@@ -0,0 +1,233 @@
+"""
+Approximate nearest-neighbour search for collections too large to scan on every query.
+
+IVFIndex is an inverted-file index: the vectors are clustered with k-means, and a query only scans the `nprobe`
+clusters whose centroids are closest to it. It has the same interface as the exact EmbeddingIndex, and either can be
+created by name with create_index and read back with load_index.
+"""
+import json
+import math
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from embeddings.index import MIN_CAPACITY, EmbeddingIndex, normalize, top_k
+
+# Number of training vectors used per cluster; more than this adds training time without improving the clusters.
+TRAINING_SAMPLES_PER_LIST = 256
+KMEANS_ITERATIONS = 10
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means: centroids of normalized vectors, normalized again after every step so that assignment is by
+    cosine similarity.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = ~sums.any(axis=1)
+        # Restart empty clusters at random vectors rather than losing them.
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour search by cosine distance over an inverted file.
+
+    The first call to add trains `nlist` centroids on the vectors it is given (by default about 4 * sqrt(n)), and
+    every vector is stored in the list of its nearest centroid, contiguously, so scanning a list is one matrix
+    product. Later calls to add assign vectors to the existing centroids without retraining; call `train` again if
+    the data drifts far from what the index was trained on. Raising nprobe improves recall at the cost of latency.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, nlist: Optional[int] = None, nprobe: int = 8, dim: Optional[int] = None):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.dim = dim
+        self.keys: List[Hashable] = []
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: List[np.ndarray] = []  # vectors of each list, with spare capacity
+        self._list_rows: List[np.ndarray] = []  # row (position in keys) of each vector in a list
+        self._list_sizes: List[int] = []
+        self._locations = np.empty((0, 2), dtype=np.int64)  # (list, slot) of each row
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, vectors: Optional[Sequence[Sequence[float]]] = None) -> None:
+        """
+        Compute the centroids from `vectors`, or from the vectors already in the index, and redistribute the stored
+        vectors among the new lists.
+        """
+        stored, keys = self.vectors, list(self.keys)
+        vectors = stored if vectors is None else normalize(vectors)
+        if not vectors.size:
+            raise ValueError("Can't train an index without vectors")
+        # Never more lists than vectors. self.nlist keeps the configured count for the next training.
+        nlist = min(self.nlist or max(1, round(4 * math.sqrt(len(vectors)))), len(vectors))
+        if len(vectors) > nlist * TRAINING_SAMPLES_PER_LIST:
+            sample = np.random.default_rng(0).choice(len(vectors), nlist * TRAINING_SAMPLES_PER_LIST, replace=False)
+            vectors = vectors[sample]
+        self.dim = vectors.shape[1]
+        self.centroids = kmeans(vectors, nlist)
+        self.keys = []
+        self._lists = [np.empty((0, self.dim), dtype=np.float32) for _ in range(nlist)]
+        self._list_rows = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        self._list_sizes = [0] * nlist
+        self._locations = np.empty((0, 2), dtype=np.int64)
+        if len(stored):
+            self._insert(stored, keys)
+
+    def add(self, vectors: Sequence[Sequence[float]], keys: Optional[Sequence[Hashable]] = None) -> None:
+        vectors = normalize(vectors)
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}")
+        if keys is None:
+            keys = range(len(self), len(self) + len(vectors))
+        elif len(keys) != len(vectors):
+            raise ValueError(f"Got {len(keys)} keys for {len(vectors)} vectors")
+        if not self.is_trained:
+            self.train(vectors)
+        self._insert(vectors, list(keys))
+
+    def _insert(self, vectors: np.ndarray, keys: List[Hashable]) -> None:
+        first_row = len(self.keys)
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        locations = np.empty((len(vectors), 2), dtype=np.int64)
+        order = np.argsort(assignments, kind="stable")
+        boundaries = np.flatnonzero(np.diff(assignments[order])) + 1
+        for members in np.split(order, boundaries):
+            if not len(members):
+                continue
+            list_id = assignments[members[0]]
+            size = self._list_sizes[list_id]
+            end = size + len(members)
+            if end > len(self._lists[list_id]):
+                capacity = max(end, 2 * len(self._lists[list_id]), MIN_CAPACITY // 16)
+                grown = np.empty((capacity, self.dim), dtype=np.float32)
+                grown[:size] = self._lists[list_id][:size]
+                rows = np.empty(capacity, dtype=np.int64)
+                rows[:size] = self._list_rows[list_id][:size]
+                self._lists[list_id], self._list_rows[list_id] = grown, rows
+            self._lists[list_id][size:end] = vectors[members]
+            self._list_rows[list_id][size:end] = first_row + members
+            self._list_sizes[list_id] = end
+            locations[members, 0] = list_id
+            locations[members, 1] = np.arange(size, end)
+        self._locations = np.concatenate([self._locations, locations])
+        self.keys.extend(keys)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        The normalized vectors in row order. Unlike EmbeddingIndex.vectors, this is a copy.
+        """
+        if not len(self):
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        result = np.empty((len(self), self.dim), dtype=np.float32)
+        for list_id, size in enumerate(self._list_sizes):
+            result[self._list_rows[list_id][:size]] = self._lists[list_id][:size]
+        return result
+
+    def vector(self, index: int) -> np.ndarray:
+        list_id, slot = self._locations[index]
+        return self._lists[list_id][slot]
+
+    def search(self, queries: Sequence[float], k: int = 10,
+               nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The approximate k nearest vectors to each query, in the same format as EmbeddingIndex.search. Rows are padded
+        with index -1 and distance inf when the probed lists hold fewer than k vectors, or none at all.
+        """
+        queries = normalize(queries)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if not len(self):
+            return indices, distances
+        probes = top_k(queries @ self.centroids.T, nprobe or self.nprobe)
+        for i, query in enumerate(queries):
+            lists = [list_id for list_id in probes[i] if self._list_sizes[list_id]]
+            if not lists:
+                # Every probed list is empty; the row stays padded.
+                continue
+            scores = np.concatenate([self._lists[list_id][:self._list_sizes[list_id]] @ query for list_id in lists])
+            rows = np.concatenate([self._list_rows[list_id][:self._list_sizes[list_id]] for list_id in lists])
+            best = top_k(scores[np.newaxis], k)[0]
+            indices[i, :len(best)] = rows[best]
+            distances[i, :len(best)] = 1 - scores[best]
+        return indices, distances
+
+    def neighbors(self, index: int, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        indices, distances = self.search(self.vector(index), k + 1)
+        keep = (indices[0] != index) & (indices[0] != -1)
+        return indices[0][keep][:k], distances[0][keep][:k]
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to an .npz file. Keys must be JSON-serializable.
+        """
+        sizes = np.array(self._list_sizes, dtype=np.int64)
+        np.savez(
+            path,
+            kind=self.kind,
+            keys=json.dumps(self.keys),
+            nprobe=self.nprobe,
+            centroids=self.centroids if self.is_trained else np.empty((0, self.dim or 0), dtype=np.float32),
+            list_sizes=sizes,
+            list_vectors=np.concatenate([self._lists[i][:size] for i, size in enumerate(sizes)]) if len(self) else
+            np.empty((0, self.dim or 0), dtype=np.float32),
+            list_rows=np.concatenate([self._list_rows[i][:size] for i, size in enumerate(sizes)]) if len(self) else
+            np.empty(0, dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            index = cls(nprobe=int(data["nprobe"]))
+            keys = json.loads(str(data["keys"]))
+            if not len(data["centroids"]):
+                return index
+            index.centroids = data["centroids"]
+            index.nlist, index.dim = index.centroids.shape
+            index._list_sizes = data["list_sizes"].tolist()
+            offsets = np.cumsum([0] + index._list_sizes)
+            index._lists = [data["list_vectors"][start:end] for start, end in zip(offsets, offsets[1:])]
+            index._list_rows = [data["list_rows"][start:end] for start, end in zip(offsets, offsets[1:])]
+        index.keys = keys
+        index._locations = np.empty((len(keys), 2), dtype=np.int64)
+        for list_id, rows in enumerate(index._list_rows):
+            index._locations[rows, 0] = list_id
+            index._locations[rows, 1] = np.arange(len(rows))
+        return index
+
+
+INDEX_TYPES: Dict[str, Type] = {
+    EmbeddingIndex.kind: EmbeddingIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+
+def create_index(kind: str = "exact", **options):
+    """
+    Create an empty index by name: "exact" for EmbeddingIndex or "ivf" for IVFIndex, with options for its
+    constructor.
+    """
+    return INDEX_TYPES[kind](**options)
+
+
+def load_index(path: str):
+    with np.load(path) as data:
+        kind = str(data["kind"])
+    return INDEX_TYPES[kind].load(path)
@@ -0,0 +1,78 @@
+"""
+Recall and latency of the IVF index against exact search, on synthetic clustered vectors.
+
+Real embeddings are far from uniformly distributed, so the vectors are drawn around random topic centres, which is
+closer to what IVF sees in practice. Run it from the repository root with `python -m embeddings.bench_ann`.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from embeddings.ann import IVFIndex
+from embeddings.index import EmbeddingIndex
+
+
+def synthetic_vectors(count: int, dim: int, topics: int, noise: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((topics, dim)).astype(np.float32)
+    vectors = centres[rng.integers(topics, size=count)]
+    vectors += noise * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected)]))
+
+
+def time_queries(index, queries: np.ndarray, k: int, **options) -> tuple:
+    """
+    Returns the results of a batched search, and the mean latency in milliseconds of single-query searches.
+    """
+    indices, _ = index.search(queries, k, **options)
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, k, **options)
+    return indices, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IVF index against exact search")
+    parser.add_argument("--vectors", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--topics", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=1.5, help="Spread of the vectors around their topic centre")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, help="Number of IVF lists (default: about 4 * sqrt(vectors))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.vectors + args.queries, args.dim, args.topics, args.noise)
+    data, queries = vectors[:args.vectors], vectors[args.vectors:]
+
+    start = time.perf_counter()
+    exact = EmbeddingIndex(data)
+    exact_build = time.perf_counter() - start
+    expected, exact_ms = time_queries(exact, queries, args.k)
+
+    start = time.perf_counter()
+    ivf = IVFIndex(nlist=args.nlist)
+    # Train on the first half and insert the rest incrementally, as a growing collection would.
+    half = len(data) // 2
+    ivf.add(data[:half])
+    ivf.add(data[half:])
+    ivf_build = time.perf_counter() - start
+
+    results = [{"index": "exact", "build_seconds": round(exact_build, 3), "query_ms": round(exact_ms, 3),
+                "recall": 1.0}]
+    for nprobe in args.nprobe:
+        found, ivf_ms = time_queries(ivf, queries, args.k, nprobe=nprobe)
+        results.append({"index": f"ivf nlist={len(ivf.centroids)} nprobe={nprobe}", "build_seconds": round(ivf_build, 3),
+                        "query_ms": round(ivf_ms, 3), "recall": round(recall(found, expected), 4)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
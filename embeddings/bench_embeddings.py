@@ -0,0 +1,62 @@
+"""
+Benchmark of the batched embedding pipeline against one request per string.
+
+Without --api-base, the mock backend from common/mock_openai.py is started in a background thread, so the benchmark
+runs without the OpenAI API. Run it from the repository root with `python -m embeddings.bench_embeddings`.
+"""
+import argparse
+import json
+import random
+import time
+from typing import List
+
+import openai
+
+from common.client import configure
+from common.mock_openai import WORDS, MockConfig, start_in_thread
+from embeddings.pipeline import EMBEDDING_MODEL, EmbeddingStats, embed_strings, request_embeddings
+
+
+def synthetic_texts(count: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [f"Plot {i}: " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(50, 600))) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched embedding requests")
+    parser.add_argument("--texts", type=int, default=5000, help="Number of strings embedded by the batched pipeline")
+    parser.add_argument("--baseline-texts", type=int, default=200,
+                        help="Number of strings embedded one request at a time, for the baseline")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=float, default=3000)
+    parser.add_argument("--tpm", type=float, default=1_000_000)
+    parser.add_argument("--api-base", help="API base URL (default: start a local mock)")
+    parser.add_argument("--embedding-latency", type=float, default=MockConfig.embedding_latency)
+    args = parser.parse_args()
+
+    openai.api_base = args.api_base or start_in_thread(MockConfig(embedding_latency=args.embedding_latency))[0]
+    openai.api_key = openai.api_key or "mock"
+    texts = synthetic_texts(args.texts)
+
+    start = time.perf_counter()
+    for text in texts[:args.baseline_texts]:
+        request_embeddings([text])
+    baseline = time.perf_counter() - start
+
+    stats = EmbeddingStats()
+    embed_strings(texts, workers=args.workers, rate_limiter=configure(EMBEDDING_MODEL, args.rpm, args.tpm), stats=stats)
+
+    print(json.dumps({
+        "baseline_texts": args.baseline_texts,
+        "baseline_seconds": round(baseline, 3),
+        "baseline_texts_per_second": round(args.baseline_texts / baseline, 1),
+        "batched_texts": args.texts,
+        "batched_seconds": round(stats.elapsed, 3),
+        "batched_texts_per_second": round(args.texts / stats.elapsed, 1),
+        "requests": stats.requests,
+        "tokens": stats.tokens,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import pickle
+import struct
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends from several processes are not serialized.
+    fcntl = None
+
+MAGIC = b"EMBCACHE"
+VERSION = 1
+# Magic, version and dimension, padded so the vectors that follow stay aligned.
+HEADER = struct.Struct("<8sII")
+KEY_DTYPE = np.dtype([("hi", "<u8"), ("lo", "<u8")])
+# Appended keys are looked up in a dict until there are this many, then merged into the sorted index.
+MERGE_THRESHOLD = 4096
+
+
+def embedding_key(string: str, model: str) -> bytes:
+    return hashlib.blake2b(f"{model}\0{string}".encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """
+    An append-only cache of embeddings keyed by (string, model), stored in two files next to each other.
+
+    `<path>.vectors` holds the vectors as raw float32 rows after a small header, and `<path>.keys` holds a 128-bit hash
+    of each row's key, in row order. Both are memory-mapped read-only, so opening the cache copies nothing, and only
+    the pages that are read are loaded. Lookups binary-search a sorted copy of the key hashes, which costs 16 bytes per
+    entry instead of a Python object per entry.
+
+    New vectors are appended in bulk: vectors first, then their keys, so a reader never sees a key whose vector isn't
+    written yet. Appends from several processes are serialized with a file lock, and readers pick up rows written by
+    other processes on their next miss.
+    """
+
+    def __init__(self, path: str, dim: Optional[int] = None):
+        self.path = path
+        self.vectors_path = f"{path}.vectors"
+        self.keys_path = f"{path}.keys"
+        self.dim = dim
+        self._size = 0
+        self._vectors = np.empty((0, dim or 0), dtype=np.float32)
+        self._keys = np.empty(0, dtype=KEY_DTYPE)
+        self._sorted_hi = np.empty(0, dtype="<u8")
+        self._order = np.empty(0, dtype=np.int64)
+        self._pending: Dict[bytes, int] = {}
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return self.get(*key) is not None
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        All cached vectors in insertion order, as a read-only memory-mapped array.
+        """
+        return self._vectors
+
+    def refresh(self) -> None:
+        """
+        Map rows appended since the cache was opened, including those written by other processes.
+        """
+        with self._lock:
+            if not os.path.exists(self.keys_path):
+                return
+            size = os.path.getsize(self.keys_path) // KEY_DTYPE.itemsize
+            if size == self._size:
+                return
+            with open(self.vectors_path, "rb") as f:
+                magic, version, dim = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{self.vectors_path} is not an embedding cache")
+            if self.dim is not None and dim != self.dim:
+                raise ValueError(f"{self.vectors_path} holds vectors of dimension {dim}, expected {self.dim}")
+            self.dim = dim
+
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", offset=HEADER.size,
+                                      shape=(size, dim))
+            self._keys = np.memmap(self.keys_path, dtype=KEY_DTYPE, mode="r", shape=(size,))
+            if size - len(self._order) > MERGE_THRESHOLD or not self._size:
+                self._order = np.argsort(self._keys["hi"], kind="stable")
+                self._sorted_hi = self._keys["hi"][self._order]
+                self._pending = {}
+            for row in range(len(self._order) + len(self._pending), size):
+                self._pending[self._keys[row].tobytes()] = row
+            self._size = size
+
+    def _rows(self, keys: List[bytes]) -> np.ndarray:
+        """
+        Row of each key, or -1 where it isn't cached.
+        """
+        hashes = np.frombuffer(b"".join(keys), dtype=KEY_DTYPE)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._order):
+            positions = np.minimum(np.searchsorted(self._sorted_hi, hashes["hi"]), len(self._order) - 1)
+            candidates = self._order[positions]
+            found = (self._sorted_hi[positions] == hashes["hi"]) & (self._keys["lo"][candidates] == hashes["lo"])
+            rows[found] = candidates[found]
+        for i in np.flatnonzero(rows == -1):
+            rows[i] = self._pending.get(keys[i], -1)
+            # Keys whose first 64 bits collide with another key's sit next to it in the sorted index.
+            position = np.searchsorted(self._sorted_hi, hashes["hi"][i]) + 1
+            while rows[i] == -1 and position < len(self._order) and self._sorted_hi[position] == hashes["hi"][i]:
+                if self._keys["lo"][self._order[position]] == hashes["lo"][i]:
+                    rows[i] = self._order[position]
+                position += 1
+        return rows
+
+    def get_many(self, strings: Sequence[str], model: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cached vectors of `strings` as a (len(strings), dim) array, and a boolean mask of which ones were found.
+        Rows of missing strings are zeros.
+        """
+        keys = [embedding_key(string, model) for string in strings]
+        with self._lock:
+            rows = self._rows(keys)
+            if (rows == -1).any() and self._stale():
+                self.refresh()
+                rows = self._rows(keys)
+            found = rows != -1
+            result = np.zeros((len(strings), self.dim or 0), dtype=np.float32)
+            result[found] = self._vectors[rows[found]]
+        return result, found
+
+    def get(self, string: str, model: str) -> Optional[np.ndarray]:
+        vectors, found = self.get_many([string], model)
+        return vectors[0] if found[0] else None
+
+    def _stale(self) -> bool:
+        try:
+            return os.path.getsize(self.keys_path) // KEY_DTYPE.itemsize != self._size
+        except FileNotFoundError:
+            return False
+
+    def put_many(self, strings: Sequence[str], model: str, vectors: Sequence[Sequence[float]]) -> int:
+        """
+        Append the vectors of strings that aren't cached yet. Returns the number of vectors written.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(strings), -1)
+        if not len(strings):
+            return 0
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}")
+
+        with self._lock, open(self.keys_path, "ab") as keys_file:
+            if fcntl is not None:
+                fcntl.flock(keys_file, fcntl.LOCK_EX)
+            self.refresh()
+            keys = [embedding_key(string, model) for string in strings]
+            new: Dict[bytes, int] = {}
+            for i, (key, row) in enumerate(zip(keys, self._rows(keys))):
+                if row == -1:
+                    new.setdefault(key, i)
+            if not new:
+                return 0
+
+            if not os.path.exists(self.vectors_path) or os.path.getsize(self.vectors_path) < HEADER.size:
+                self.dim = vectors.shape[1]
+                with open(self.vectors_path, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, VERSION, self.dim))
+            with open(self.vectors_path, "r+b") as f:
+                # Rows past the last key are left over from an interrupted append; overwrite them.
+                f.seek(HEADER.size + self._size * self.dim * 4)
+                f.write(vectors[list(new.values())].tobytes())
+                f.truncate()
+                f.flush()
+            keys_file.write(b"".join(new))
+            keys_file.flush()
+            self.refresh()
+        return len(new)
+
+    def put(self, string: str, model: str, vector: Sequence[float]) -> None:
+        self.put_many([string], model, [vector])
+
+    def import_pickle(self, pickle_file: str) -> int:
+        """
+        Copy the entries of a pickled {(string, model): embedding} dict (the format the embeddings notebook used to
+        write) into this cache, without overwriting existing keys. Returns the number of entries read.
+        """
+        if not os.path.exists(pickle_file):
+            return 0
+        with open(pickle_file, "rb") as f:
+            entries = pickle.load(f)
+        by_model: Dict[str, Tuple[List[str], List[Sequence[float]]]] = {}
+        for (string, model), embedding in entries.items():
+            strings, vectors = by_model.setdefault(model, ([], []))
+            strings.append(string)
+            vectors.append(embedding)
+        for model, (strings, vectors) in by_model.items():
+            self.put_many(strings, model, vectors)
+        return len(entries)
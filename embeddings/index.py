@@ -0,0 +1,119 @@
+import json
+from typing import Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+MIN_CAPACITY = 1024
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale rows to unit length in float32, so cosine similarity becomes a dot product. Zero rows are left as zeros.
+    """
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Column indices of the k highest scores in each row, best first. argpartition finds them in linear time, and only
+    those k are sorted.
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class EmbeddingIndex:
+    """
+    Exact nearest-neighbour search over embeddings by cosine distance.
+
+    Vectors are normalized once and kept in one contiguous float32 matrix, so a query is a single matrix product
+    followed by a top-k selection, and a batch of queries is a single matrix-matrix product. Each vector can carry a
+    key (such as the text it embeds); by default the key is its position. Rows are added in place with amortized
+    growth, so the index can be extended without rebuilding it.
+    """
+
+    kind = "exact"
+
+    def __init__(self, vectors: Optional[Sequence[Sequence[float]]] = None, keys: Optional[Sequence[Hashable]] = None,
+                 dim: Optional[int] = None):
+        self.dim = dim
+        self._matrix = np.empty((0, dim or 0), dtype=np.float32)
+        self._size = 0
+        self.keys: List[Hashable] = []
+        if vectors is not None and len(vectors):
+            self.add(vectors, keys)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        The normalized vectors, one per row. This is a view into the index, not a copy.
+        """
+        return self._matrix[:self._size]
+
+    def add(self, vectors: Sequence[Sequence[float]], keys: Optional[Sequence[Hashable]] = None) -> None:
+        vectors = normalize(vectors)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}")
+        if keys is None:
+            keys = range(self._size, self._size + len(vectors))
+        elif len(keys) != len(vectors):
+            raise ValueError(f"Got {len(keys)} keys for {len(vectors)} vectors")
+
+        end = self._size + len(vectors)
+        if end > len(self._matrix):
+            matrix = np.empty((max(end, 2 * len(self._matrix), MIN_CAPACITY), self.dim), dtype=np.float32)
+            matrix[:self._size] = self.vectors
+            self._matrix = matrix
+        self._matrix[self._size:end] = vectors
+        self._size = end
+        self.keys.extend(keys)
+
+    def search(self, queries: Sequence[float], k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest vectors to each query. Returns (indices, distances), each of shape (number of queries, k), with
+        cosine distances in increasing order. A single query vector may be passed as a 1-D array.
+        """
+        scores = normalize(queries) @ self.vectors.T
+        indices = top_k(scores, k)
+        return indices, 1 - np.take_along_axis(scores, indices, axis=1)
+
+    def neighbors(self, index: int, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest vectors to the one at `index`, excluding itself.
+        """
+        indices, distances = self.search(self.vectors[index], k + 1)
+        keep = indices[0] != index
+        return indices[0][keep][:k], distances[0][keep][:k]
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to an .npz file. Keys must be JSON-serializable.
+        """
+        np.savez(path, kind=self.kind, keys=json.dumps(self.keys), vectors=self.vectors)
+
+    @classmethod
+    def load(cls, path: str) -> "EmbeddingIndex":
+        with np.load(path) as data:
+            index = cls(dim=data["vectors"].shape[1])
+            # The vectors were normalized when they were added, so they are copied in as they are.
+            index._matrix = data["vectors"]
+            index._size = len(index._matrix)
+            index.keys = json.loads(str(data["keys"]))
+        return index
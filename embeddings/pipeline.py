@@ -0,0 +1,183 @@
+import base64
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import openai
+from openai.error import InvalidRequestError, OpenAIError
+
+from common.client import call_with_retries, limiter_for
+from common.ratelimit import RateLimiter
+from common.tokens import count_tokens_batch
+from common.tracing import span
+from common.usage import record_response
+from embeddings.cache import EmbeddingCache
+
+LOGGER = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Most inputs the API accepts in a single request.
+MAX_BATCH_INPUTS = 2048
+# Tokens sent per request. Larger batches mean fewer round trips, but a failed batch costs more to retry.
+MAX_BATCH_TOKENS = 50_000
+MAX_ATTEMPTS = 6
+
+
+class EmbeddingError(Exception):
+    """
+    Raised when some batches still failed after retrying. The strings that were embedded are already in the cache, so
+    calling again only requests the ones in `failed`.
+    """
+
+    def __init__(self, message: str, failed: List[str]):
+        super().__init__(message)
+        self.failed = failed
+
+
+@dataclass
+class EmbeddingStats:
+    cached: int = 0
+    embedded: int = 0
+    tokens: int = 0
+    requests: int = 0
+    retries: int = 0
+    splits: int = 0
+    elapsed: float = 0.0
+    failed: List[str] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, **counts: int) -> None:
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def __str__(self):
+        return (f"{self.embedded} embedded and {self.cached} cached in {self.elapsed:.2f}s, {self.tokens} tokens in "
+                f"{self.requests} requests ({self.retries} retries, {self.splits} splits, {len(self.failed)} failed)")
+
+
+def prepare_text(text: str) -> str:
+    # Replace newlines, which can negatively affect performance.
+    return text.replace("\n", " ")
+
+
+def make_batches(token_counts: Sequence[int], max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_batch_inputs: int = MAX_BATCH_INPUTS) -> List[List[int]]:
+    """
+    Group consecutive inputs into batches of at most max_batch_tokens tokens and max_batch_inputs inputs. Returns the
+    indices of the inputs in each batch. An input that is larger than the budget on its own gets a batch to itself.
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    batch_tokens = 0
+    for i, tokens in enumerate(token_counts):
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_inputs):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def request_embeddings(texts: List[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """
+    Embed a list of texts in one request, as a (len(texts), dim) float32 array.
+    """
+    # Asking for base64 explicitly skips the client's conversion of every vector to a list of Python floats.
+    start = time.perf_counter()
+    with span("request", model=model, call_site="embeddings", texts=len(texts)):
+        response = openai.Embedding.create(input=texts, model=model, encoding_format="base64")
+    record_response(response, model, time.perf_counter() - start, call_site="embeddings")
+    rows = [None] * len(texts)
+    for data in response.data:
+        embedding = data["embedding"]
+        if isinstance(embedding, str):
+            rows[data["index"]] = np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+        else:
+            rows[data["index"]] = np.asarray(embedding, dtype=np.float32)
+    return np.stack(rows)
+
+
+def embed_batch(texts: List[str], model: str, rate_limiter: Optional[RateLimiter] = None,
+                stats: Optional[EmbeddingStats] = None) -> np.ndarray:
+    """
+    Embed one batch under `rate_limiter` (by default the one shared by every caller of `model`), retrying transient
+    errors. A batch the API rejects as invalid (usually too many tokens or inputs) is split in half and each half is
+    sent on its own, so an oversized batch shrinks until it fits.
+    """
+    stats = stats if stats is not None else EmbeddingStats()
+    rate_limiter = rate_limiter or limiter_for(model)
+
+    def request() -> np.ndarray:
+        stats.record(requests=1)
+        return request_embeddings(texts, model)
+
+    try:
+        return call_with_retries(request, rate_limiter, sum(count_tokens_batch(texts, model)), MAX_ATTEMPTS,
+                                 on_retry=lambda error, attempt: stats.record(retries=1))
+    except InvalidRequestError:
+        if len(texts) == 1:
+            raise
+        stats.record(splits=1)
+        middle = len(texts) // 2
+        return np.concatenate([embed_batch(texts[:middle], model, rate_limiter, stats),
+                               embed_batch(texts[middle:], model, rate_limiter, stats)])
+
+
+def embed_strings(strings: Sequence[str], model: str = EMBEDDING_MODEL, cache: Optional[EmbeddingCache] = None,
+                  workers: int = 4, rate_limiter: Optional[RateLimiter] = None,
+                  max_batch_tokens: int = MAX_BATCH_TOKENS, stats: Optional[EmbeddingStats] = None) -> np.ndarray:
+    """
+    Embed many strings with as few requests as possible, returning a (len(strings), dim) float32 array in the order
+    of `strings`.
+
+    Strings found in `cache` are not sent. The rest are grouped into multi-input requests by token count, and up to
+    `workers` requests run at once under `rate_limiter` (by default the one shared by every caller of `model`). Each
+    batch is written to the cache as soon as it arrives, so an interrupted run loses at most the batches in flight.
+    Batches that still fail after retrying are reported with an EmbeddingError once all the others are done.
+    """
+    stats = stats if stats is not None else EmbeddingStats()
+    start = time.perf_counter()
+    unique = list(dict.fromkeys(strings))
+    vectors: Dict[str, np.ndarray] = {}
+    if cache is not None:
+        cached, found = cache.get_many(unique, model)
+        vectors.update((string, vector) for string, vector, hit in zip(unique, cached, found) if hit)
+    missing = [string for string in unique if string not in vectors]
+    stats.cached += len(unique) - len(missing)
+
+    texts = [prepare_text(string) for string in missing]
+    token_counts = count_tokens_batch(texts, model)
+    rate_limiter = rate_limiter or limiter_for(model)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(embed_batch, [texts[i] for i in batch], model, rate_limiter, stats): batch
+            for batch in make_batches(token_counts, max_batch_tokens)
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            batch_strings = [missing[i] for i in batch]
+            try:
+                batch_vectors = future.result()
+            except OpenAIError as e:
+                LOGGER.warning(f"Embedding a batch of {len(batch)} strings failed. {e}")
+                stats.failed.extend(batch_strings)
+                continue
+            if cache is not None:
+                cache.put_many(batch_strings, model, batch_vectors)
+            vectors.update(zip(batch_strings, batch_vectors))
+            stats.embedded += len(batch)
+            stats.tokens += sum(token_counts[i] for i in batch)
+    stats.elapsed += time.perf_counter() - start
+
+    if stats.failed:
+        raise EmbeddingError(f"{len(stats.failed)} of {len(missing)} strings could not be embedded", stats.failed)
+    if not strings:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack([vectors[string] for string in strings])
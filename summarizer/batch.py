@@ -0,0 +1,179 @@
+"""
+Summarize many documents in one run:
+
+    python batch.py manifest.jsonl --targets 500 1000 --documents 4 --output summaries.jsonl
+
+The manifest lists one document per line, either as a path or as a JSON object such as
+{"id": "peter-pan", "path": "books/16-0.txt", "gutenberg": true}. Documents are tracked in a job store
+(jobs.sqlite3 by default), so running the same command again skips the documents that are done and resumes the rest.
+Chunk summaries are cached in cache.sqlite3, so a resumed document doesn't pay for them twice.
+
+Several documents are read and split at once, and the chunk summaries of all of them run on one shared pool, so the
+pool stays full while individual documents are being read, waiting on their last reduce steps or synthesizing.
+"""
+import argparse
+import json
+import sys
+from concurrent.futures import as_completed
+from typing import Dict, List
+
+from ingest import open_text, read_blocks, strip_gutenberg_blocks
+from jobs import DONE, FAILED, PENDING, RUNNING, Job, JobStore
+from summarize import (DIVISION_POINTS, MAX_CONCURRENT_REQUESTS, model_name, summarize_stream_for_targets,
+                       synthesize_summaries)
+from utilities import ContextThreadPoolExecutor
+
+# utilities puts the repository root on sys.path.
+from common import tracing
+from common.usage import metering, usage_labels
+
+
+def load_manifest(path: str, gutenberg: bool = False) -> List[Job]:
+    """
+    Read the documents listed in a manifest. Plain lines are paths, and their id is the path. `gutenberg` is the
+    default for documents that don't say.
+    """
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                document = entry["path"]
+                jobs.append(Job(str(entry.get("id", document)), document, bool(entry.get("gutenberg", gutenberg))))
+            else:
+                jobs.append(Job(line, line, gutenberg))
+    return jobs
+
+
+def run_job(job: Job, store: JobStore, pool: ContextThreadPoolExecutor, args) -> Job:
+    """
+    Summarize one document on the shared pool and record the outcome, with the tokens it used, in the store.
+    """
+    store.start(job.id)
+    # Every request made for this document, on whichever pool thread, is labelled with it and also recorded in
+    # `meter`, which only counts this attempt.
+    with metering() as meter, usage_labels(document=job.id):
+        try:
+            summaries = summarize_job(job, args, pool)
+        except Exception as e:
+            # One bad document (unreadable, or failing requests after retries) must not stop the batch.
+            usage = meter.total()
+            store.fail(job.id, f"{type(e).__name__}: {e}", usage.prompt_tokens, usage.completion_tokens, usage.cost)
+        else:
+            usage = meter.total()
+            store.finish(job.id, summaries, usage.prompt_tokens, usage.completion_tokens, usage.cost)
+    return job
+
+
+def summarize_job(job: Job, args, pool: ContextThreadPoolExecutor) -> Dict[str, str]:
+    with open_text(job.path) as f:
+        blocks = read_blocks(f)
+        if job.gutenberg:
+            blocks = strip_gutenberg_blocks(blocks)
+        summaries = summarize_stream_for_targets(
+            blocks, args.targets, args.context_size, DIVISION_POINTS, args.model, pool
+        )
+    results = {
+        str(target_summary_size): summary.replace("[[[", "").replace("]]]", "")
+        for target_summary_size, summary in summaries.items()
+    }
+    if args.synthesize_with and len(results) > 1:
+        results["synthesized"] = synthesize_summaries(list(results.values()), args.synthesize_with)
+    return results
+
+
+def run_batch(store: JobStore, args) -> None:
+    """
+    Run every job in the store that isn't done and hasn't been started max_attempts times already. A job left
+    running counts as an attempt too, so a document that keeps crashing or hanging the batch is given up on as well.
+    """
+    jobs = [
+        job for job in store.jobs([PENDING, RUNNING, FAILED])
+        if job.status == PENDING or job.attempts < args.max_attempts
+    ]
+    print(f"Summarizing {len(jobs)} documents, {args.documents} at a time on {args.workers} workers")
+    with ContextThreadPoolExecutor(max_workers=args.workers) as pool, \
+            ContextThreadPoolExecutor(max_workers=args.documents) as documents:
+        futures = [documents.submit(run_job, job, store, pool, args) for job in jobs]
+        for i, future in enumerate(as_completed(futures), start=1):
+            print(f"Finished {i}/{len(jobs)}: {future.result().id}")
+
+
+def report(jobs: List[Job]) -> str:
+    width = max([len("Document")] + [len(job.id) for job in jobs])
+    lines = [f"{'Document':<{width}}  {'Status':<7}  {'Attempts':>8}  {'Tokens':>10}  {'Cost':>9}"]
+    for job in jobs:
+        tokens = job.prompt_tokens + job.completion_tokens
+        lines.append(f"{job.id:<{width}}  {job.status:<7}  {job.attempts:>8}  {tokens:>10}  ${job.cost:>8.4f}")
+    total_tokens = sum(job.prompt_tokens + job.completion_tokens for job in jobs)
+    lines.append(f"{'Total':<{width}}  {'':<7}  {'':>8}  {total_tokens:>10}  ${sum(job.cost for job in jobs):>8.4f}")
+    return "\n".join(lines)
+
+
+def write_results(jobs: List[Job], output: str) -> None:
+    with open(output, "w", encoding="utf-8") as f:
+        for job in jobs:
+            if job.status == DONE:
+                f.write(json.dumps({
+                    "id": job.id,
+                    "path": job.path,
+                    "summaries": job.summaries,
+                    "prompt_tokens": job.prompt_tokens,
+                    "completion_tokens": job.completion_tokens,
+                    "cost": round(job.cost, 6),
+                }) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the documents listed in a manifest, resumably")
+    parser.add_argument("manifest", help="File listing the documents: one path or JSON object per line")
+    parser.add_argument("--targets", type=int, nargs="+", default=[1000], help="Target summary sizes in tokens")
+    parser.add_argument("--model", default=model_name, help=f"The model to summarize with (default: {model_name})")
+    parser.add_argument("--context-size", type=int, default=4097, help="Context window of the model, in tokens")
+    parser.add_argument("--gutenberg", action="store_true",
+                        help="Strip Project Gutenberg headers and footers from documents that don't say")
+    parser.add_argument("--synthesize-with", metavar="MODEL",
+                        help="Also combine the summaries of each document into one with this model, e.g. gpt-4")
+    parser.add_argument("--documents", type=int, default=4, help="Documents read and summarized at once")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help="Threads in the pool shared by the chunk summaries of all documents")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Stop retrying a document that failed or was interrupted this many times")
+    parser.add_argument("--store", default="jobs.sqlite3", help="Job store used to resume an interrupted batch")
+    parser.add_argument("--output", default="summaries.jsonl", help="Where to write the finished summaries")
+    parser.add_argument("--usage-report", metavar="PATH",
+                        help="Write the tokens, cost and latency of this run per model, document and call site to "
+                             "PATH, as JSON or, for a .prom file, as Prometheus metrics")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Record where the time goes and write it to PATH in the Chrome trace format")
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable()
+
+    store = JobStore(args.store)
+    try:
+        added = store.add(load_manifest(args.manifest, args.gutenberg))
+        print(f"Added {added} new documents to {args.store}")
+        with metering() as usage:
+            run_batch(store, args)
+        jobs = store.jobs()
+    finally:
+        store.close()
+
+    write_results(jobs, args.output)
+    if args.usage_report:
+        usage.write(args.usage_report)
+    if args.trace:
+        tracing.write_trace(args.trace)
+        print(tracing.format_summary())
+    print(report(jobs))
+    print(f"Wrote the summaries of {sum(1 for job in jobs if job.status == DONE)} documents to {args.output}")
+    if any(job.status != DONE for job in jobs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
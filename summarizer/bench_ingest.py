@@ -0,0 +1,95 @@
+"""
+Peak memory of reading and splitting a large text file into summarization sections, streamed (ingest.py and
+iter_stream_sections) versus loaded whole (strip_gutenberg and split_text_into_sections).
+
+Synthetic books with a Project Gutenberg header and footer are written to a temporary directory, and each one is
+split in a fresh process so the peak RSS of one run doesn't carry over to the next. No requests are sent.
+
+    python bench_ingest.py --megabytes 1 16 64
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from ingest import open_text, read_blocks, strip_gutenberg, strip_gutenberg_blocks
+from summarize import DIVISION_POINTS, model_name
+from utilities import iter_stream_sections, split_text_into_sections
+
+WORDS = ("the darling children flew out of the nursery window towards the island where lost boys and pirates "
+         "wait for a story about growing up").split()
+SECTION_TOKENS = 3000
+
+
+def write_book(path: str, megabytes: float, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    size = int(megabytes * (1 << 20))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("The Project Gutenberg eBook of a benchmark\r\n\r\n*** START OF THE PROJECT GUTENBERG EBOOK ***\r\n")
+        written = 0
+        while written < size:
+            paragraph = ". ".join(
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 25))).capitalize()
+                for _ in range(rng.randint(2, 8))
+            ) + ".\r\n\r\n"
+            f.write(paragraph)
+            written += len(paragraph)
+        f.write("*** END OF THE PROJECT GUTENBERG EBOOK ***\r\nThe license follows.\r\n")
+
+
+def measure(mode: str, path: str) -> dict:
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    sections = 0
+    if mode == "stream":
+        with open_text(path) as f:
+            for section in iter_stream_sections(strip_gutenberg_blocks(read_blocks(f)), SECTION_TOKENS,
+                                                DIVISION_POINTS, model_name):
+                digest.update(section.encode("utf-8"))
+                sections += 1
+    else:
+        with open(path, encoding="utf-8", newline="") as f:
+            book = strip_gutenberg(f.read())
+        for section in split_text_into_sections(book, SECTION_TOKENS, DIVISION_POINTS, model_name):
+            digest.update(section.encode("utf-8"))
+            sections += 1
+    return {
+        "seconds": round(time.perf_counter() - start, 2),
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "sections": sections,
+        "sha256": digest.hexdigest()[:16],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the peak memory of streamed and in-memory ingestion")
+    parser.add_argument("--megabytes", type=float, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--modes", nargs="+", choices=["stream", "memory"], default=["stream", "memory"])
+    parser.add_argument("--measure", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(*args.measure)))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for megabytes in args.megabytes:
+            path = os.path.join(directory, f"book_{megabytes:g}mb.txt")
+            write_book(path, megabytes)
+            for mode in args.modes:
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", mode, path],
+                                        capture_output=True, text=True, check=True).stdout
+                results.append({"megabytes": megabytes, "mode": mode, **json.loads(output)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
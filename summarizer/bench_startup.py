@@ -0,0 +1,92 @@
+"""
+Startup benchmark of the summarizer library: how long `import summarize` takes in a fresh interpreter.
+
+Each run imports the module in a new process, from an empty working directory and without OPENAI_API_KEY, and checks
+that the import sent no requests, created no files and left the heavy client modules unimported. The benchmark exits
+with status 1 when the median import time is over the budget, so it can run as a check:
+
+    python bench_startup.py --budget-ms 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_BUDGET_MS = 150.0
+# Modules that must only be imported once a request is actually made.
+LAZY_MODULES = ("openai", "requests", "aiohttp", "numpy")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+
+def probe_env() -> Dict[str, str]:
+    env = {name: value for name, value in os.environ.items() if name != "OPENAI_API_KEY"}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [HERE, env.get("PYTHONPATH")]))
+    return env
+
+
+def run_import(module: str, directory: str) -> Dict:
+    output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, lazy=LAZY_MODULES)], cwd=directory,
+                            env=probe_env(), capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def slowest_imports(module: str, directory: str, count: int) -> List[Dict]:
+    """
+    The modules with the largest cumulative import time, from -X importtime.
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=directory,
+                            env=probe_env(), capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append({"module": name.strip(), "ms": int(cumulative) / 1000})
+    return sorted(rows, key=lambda row: row["ms"], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of the summarizer")
+    parser.add_argument("--module", default="summarize")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest imports to list")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        runs = [run_import(args.module, directory) for _ in range(args.runs)]
+        top = slowest_imports(args.module, directory, args.top)
+        created = sorted(os.listdir(directory))
+
+    times = [run["seconds"] * 1000 for run in runs]
+    loaded = sorted({name for run in runs for name in run["loaded"]})
+    median = statistics.median(times)
+    ok = median <= args.budget_ms and not loaded and not created
+    print(json.dumps({
+        "module": args.module,
+        "runs": args.runs,
+        "median_ms": round(median, 1),
+        "max_ms": round(max(times), 1),
+        "budget_ms": args.budget_ms,
+        "eagerly_loaded": loaded,
+        "files_created": created,
+        "slowest_imports": top,
+        "ok": ok,
+    }, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Summarize local text files, or standard input, from the command line:
+
+    python cli.py book.txt --targets 500 750 1000 --gutenberg --synthesize-with gpt-4
+    curl -s https://www.gutenberg.org/files/16/16-0.txt | python cli.py - --gutenberg
+
+Files are read incrementally, so memory use doesn't grow with their size. Progress is logged to stderr and the
+summaries are written to stdout.
+"""
+import argparse
+import contextlib
+import sys
+from typing import Dict
+
+from ingest import open_text, read_blocks, strip_gutenberg_blocks
+from summarize import DIVISION_POINTS, gpt_summarize, model_name, summarize_stream_for_targets, synthesize_summaries
+
+# utilities, imported by summarize, puts the repository root on sys.path.
+from common import tracing
+from common.usage import metering, usage_labels
+
+
+def summarize_file(path: str, args) -> Dict[int, str]:
+    with open_text(path) as f:
+        blocks = read_blocks(f)
+        if args.gutenberg:
+            blocks = strip_gutenberg_blocks(blocks)
+        summaries = summarize_stream_for_targets(blocks, args.targets, args.context_size, DIVISION_POINTS, args.model)
+    return {
+        target_summary_size: summary.replace("[[[", "").replace("]]]", "")
+        for target_summary_size, summary in summaries.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize long texts with recursive GPT summaries")
+    parser.add_argument("files", nargs="*", default=["-"], help="Text files to summarize, or - for stdin (default)")
+    parser.add_argument("--targets", type=int, nargs="+", default=[1000],
+                        help="Target summary sizes in tokens; one summary is written for each")
+    parser.add_argument("--model", default=model_name, help=f"The model to summarize with (default: {model_name})")
+    parser.add_argument("--context-size", type=int, default=4097, help="Context window of the model, in tokens")
+    parser.add_argument("--gutenberg", action="store_true", help="Strip the Project Gutenberg header and footer")
+    parser.add_argument("--synthesize-with", metavar="MODEL",
+                        help="Also combine the summaries of each file into one with this model, e.g. gpt-4")
+    parser.add_argument("--usage-report", metavar="PATH",
+                        help="Write the tokens, cost and latency per model, file and call site to PATH, as JSON or, "
+                             "for a .prom file, as Prometheus metrics")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Record where the time goes and write it to PATH in the Chrome trace format")
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable()
+
+    results = {}
+    # The library reports its progress with print; keep stdout for the summaries.
+    with contextlib.redirect_stdout(sys.stderr), metering() as usage:
+        for path in args.files:
+            with usage_labels(document=path):
+                summaries = summarize_file(path, args)
+                synthesized = None
+                if args.synthesize_with and len(summaries) > 1:
+                    synthesized = synthesize_summaries(list(summaries.values()), args.synthesize_with)
+            results[path] = summaries, synthesized
+        print(f"Chunk summary cache: {gpt_summarize.cache_stats}")
+        print(f"Used {usage}")
+        if args.usage_report:
+            usage.write(args.usage_report)
+        if args.trace:
+            tracing.write_trace(args.trace)
+            print(tracing.format_summary())
+
+    for path, (summaries, synthesized) in results.items():
+        for target_summary_size, summary in summaries.items():
+            print(f"# {path} ({target_summary_size} tokens)\n\n{summary}\n")
+        if synthesized is not None:
+            print(f"# {path} (synthesized by {args.synthesize_with})\n\n{synthesized}\n")
+
+
+if __name__ == "__main__":
+    main()
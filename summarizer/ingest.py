@@ -0,0 +1,85 @@
+"""
+Reading the text to summarize: whole, or incrementally in blocks so that a large file is never held in memory at once.
+"""
+import contextlib
+import re
+import sys
+from typing import IO, Iterable, Iterator
+
+# Characters read from a file at a time.
+READ_BLOCK_CHARS = 1 << 20
+# A Project Gutenberg header ends within this many characters; text with no marker this far in has no header.
+GUTENBERG_HEADER_CHARS = 1 << 16
+# The "*** START OF THE PROJECT GUTENBERG EBOOK ... ***" and "*** END OF ... ***" lines around the book.
+GUTENBERG_MARKER = re.compile(r"\*\*\* .+ \*\*\*")
+
+
+@contextlib.contextmanager
+def open_text(path: str) -> Iterator[IO[str]]:
+    """
+    Open a UTF-8 text file for reading, or standard input for "-".
+    """
+    if path == "-":
+        yield sys.stdin
+        return
+    with open(path, encoding="utf-8", errors="replace", newline="") as f:
+        yield f
+
+
+def read_blocks(file: IO[str], block_chars: int = READ_BLOCK_CHARS) -> Iterator[str]:
+    """
+    Read a text file in blocks of up to block_chars characters, without carriage returns.
+    """
+    while True:
+        block = file.read(block_chars)
+        if not block:
+            return
+        yield block.replace("\r", "")
+
+
+def strip_gutenberg(text: str) -> str:
+    """
+    Remove the Project Gutenberg header and footer (and carriage returns) from a book. The book is the part between
+    the first two marker lines; text without them is returned unchanged.
+    """
+    text = text.replace("\r", "")
+    split = GUTENBERG_MARKER.split(text)
+    return split[1] if len(split) > 1 else text
+
+
+def strip_gutenberg_blocks(blocks: Iterable[str], header_chars: int = GUTENBERG_HEADER_CHARS) -> Iterator[str]:
+    """
+    strip_gutenberg for text read in blocks. Only whole lines are searched for the markers, so a marker split
+    between two blocks is still found. When no marker turns up in the first header_chars characters, the text is
+    passed through unchanged.
+    """
+    blocks = iter(blocks)
+    pending = ""
+    for block in blocks:
+        pending += block
+        lines_end = pending.rfind("\n") + 1
+        match = GUTENBERG_MARKER.search(pending, 0, lines_end)
+        if match:
+            pending = pending[match.end():]
+            break
+        if len(pending) > header_chars:
+            yield pending
+            yield from blocks
+            return
+    else:
+        # The text ended within what could still have been the header.
+        yield strip_gutenberg(pending)
+        return
+
+    for block in blocks:
+        pending += block
+        lines_end = pending.rfind("\n") + 1
+        match = GUTENBERG_MARKER.search(pending, 0, lines_end)
+        if match:
+            yield pending[:match.start()]
+            return
+        if lines_end:
+            yield pending[:lines_end]
+            pending = pending[lines_end:]
+    match = GUTENBERG_MARKER.search(pending)
+    yield pending[:match.start()] if match else pending
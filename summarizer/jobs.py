@@ -0,0 +1,108 @@
+"""
+A job store for batch summarization (see batch.py), kept in SQLite so a run that stops part way can be resumed.
+"""
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    path: str
+    gutenberg: bool = False
+    status: str = PENDING
+    attempts: int = 0
+    # Tokens and cost are summed over the attempts that finished or failed. An attempt cut short by a crash isn't
+    # counted, but the chunk summaries it paid for are cached and cost nothing when the document is resumed.
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    summaries: Dict[str, str] = field(default_factory=dict)
+    error: str = ""
+
+
+class JobStore:
+    """
+    Documents to summarize and how far each one got. Every change is committed right away, so after a crash the
+    store shows which documents are done; the others start over, and the chunk summaries they had already paid for
+    come from the summary cache instead of being requested again.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, path TEXT NOT NULL, gutenberg INTEGER NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+            "cost REAL NOT NULL, summaries TEXT NOT NULL, error TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def add(self, jobs: Iterable[Job]) -> int:
+        """
+        Add jobs that aren't in the store yet, and return how many were added. Jobs already there keep their state.
+        """
+        rows = [(job.id, job.path, int(job.gutenberg), time.time()) for job in jobs]
+        with self._lock:
+            before = self._count()
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, 'pending', 0, 0, 0, 0.0, '{}', '', ?)", rows
+            )
+            self._connection.execute("COMMIT")
+            return self._count() - before
+
+    def jobs(self, statuses: Optional[Iterable[str]] = None) -> List[Job]:
+        query = "SELECT * FROM jobs"
+        params: List[str] = []
+        if statuses is not None:
+            params = list(statuses)
+            query += f" WHERE status IN ({', '.join('?' * len(params))})"
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY rowid", params).fetchall()
+        return [
+            Job(id, path, bool(gutenberg), status, attempts, prompt_tokens, completion_tokens, cost,
+                json.loads(summaries), error)
+            for id, path, gutenberg, status, attempts, prompt_tokens, completion_tokens, cost, summaries, error, _
+            in rows
+        ]
+
+    def start(self, job_id: str) -> None:
+        self._execute("UPDATE jobs SET status = ?, attempts = attempts + 1, error = '', updated_at = ? WHERE id = ?",
+                      RUNNING, time.time(), job_id)
+
+    def finish(self, job_id: str, summaries: Dict[str, str], prompt_tokens: int, completion_tokens: int,
+               cost: float) -> None:
+        self._execute(
+            "UPDATE jobs SET status = ?, summaries = ?, prompt_tokens = prompt_tokens + ?, "
+            "completion_tokens = completion_tokens + ?, cost = cost + ?, updated_at = ? WHERE id = ?",
+            DONE, json.dumps(summaries), prompt_tokens, completion_tokens, cost, time.time(), job_id,
+        )
+
+    def fail(self, job_id: str, error: str, prompt_tokens: int, completion_tokens: int, cost: float) -> None:
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, prompt_tokens = prompt_tokens + ?, "
+            "completion_tokens = completion_tokens + ?, cost = cost + ?, updated_at = ? WHERE id = ?",
+            FAILED, error, prompt_tokens, completion_tokens, cost, time.time(), job_id,
+        )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _count(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def _execute(self, query: str, *params) -> None:
+        with self._lock:
+            self._connection.execute(query, params)
@@ -1,53 +1,41 @@
+"""
+Recursive summarization of long texts. Importing this module has no side effects: the API client, the API key and
+the summary cache are set up on first use, so it can be imported cheaply from other code. See cli.py for the
+command line.
+"""
 from __future__ import division
-import os
 import re
 import textwrap
 
-from utilities import num_tokens_from_messages, summarization_prompt_messages, split_text_into_sections, memoize_to_file, split_text_into_sections
-from typing import Dict, List
+from utilities import count_tokens, num_tokens_from_messages, summarization_prompt_messages, iter_text_sections, iter_stream_sections, split_text_into_sections, memoize_to_file, summary_cache_key, openai_client, ContextThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Sequence, TypeVar, Union
 
-import tiktoken
-import openai
-import requests
-import random
-import time
-
-from dotenv import load_dotenv
-from openai.error import APIConnectionError, APIError, RateLimitError
+import contextlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 
+# Sibling chunks are summarized concurrently, on one pool of this many threads shared by every level of the
+# recursion, so it caps the requests in flight across the whole summarization tree. The model's shared limiter (see
+# common.client) applies on top of it. Set it to 1 to run sequentially.
+MAX_CONCURRENT_REQUESTS = 8
+# Sections of a streamed text that are read ahead of the oldest one still being summarized. This bounds how much of
+# the text is held in memory while keeping every worker busy.
+STREAM_LOOKAHEAD = 2 * MAX_CONCURRENT_REQUESTS
 
-load_dotenv(".env")
-openai.api_key = os.environ["OPENAI_API_KEY"]
+T = TypeVar("T")
+R = TypeVar("R")
 
-actual_tokens = 0
 
-
-def gpt_summarize(text: str, target_summary_size: int) -> str:
-    global actual_tokens
-    # Otherwise, we can just summarize the text directly
-    tries = 0
-    while True:
-        try:
-            tries += 1
-            result = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=summarization_prompt_messages(text, target_summary_size),
-            )
-            actual_tokens += result.usage.total_tokens
-            return "[[[" + result.choices[0].message.to_dict()["content"] + "]]]"
-        except (APIConnectionError, APIError, RateLimitError) as e:
-            if tries >= MAX_ATTEMPTS:
-                print(f"OpenAI exception after {MAX_ATTEMPTS} tries. Aborting. {e}")
-                raise e
-            if hasattr(e, "should_retry") and not e.should_retry:
-                print(f"OpenAI exception with should_retry false. Aborting. {e}")
-                raise e
-            else:
-                print(f"Summarize failed (Try {tries} of {MAX_ATTEMPTS}). {e}")
-                random_wait = random.random() * 4.0 + 1.0  # Wait between 1 and 5 seconds
-                random_wait = random_wait * tries  # Scale that up by the number of tries (more tries, longer wait)
-                time.sleep(random_wait * tries)
-from dataclasses import dataclass
+# Summaries are cached per chunk by content (see summary_cache_key), so a chunk that is unchanged between runs is
+# never paid for twice, even when the text around it or the chunk boundaries change.
+@memoize_to_file(cache_file="cache.sqlite3", key_func=summary_cache_key)
+def gpt_summarize(text: str, target_summary_size: int, model: str = "gpt-3.5-turbo") -> str:
+    # Otherwise, we can just summarize the text directly. chat_completion waits for the model's shared rate limit and
+    # retries transient errors.
+    result = openai_client().chat_completion(summarization_prompt_messages(text, target_summary_size), model,
+                                             call_site="summarizer.chunk")
+    return "[[[" + result.choices[0].message.to_dict()["content"] + "]]]"
 
 # Using repr allows us to use this is in our memoization function.
 # Specifying frozen=True causes python to generate a __hash__ and __eq__ function for us.
@@ -74,37 +62,232 @@ def summarization_token_parameters(target_summary_size: int, model_context_size:
 import re
 
 
+def map_on_pool(pool: ThreadPoolExecutor, fn: Callable[[T], R], items: Iterable[T]) -> List[R]:
+    """
+    pool.map for tasks that may themselves wait on tasks of the same pool. Items no worker has started by the time
+    their result is needed are run by the waiting thread instead, so the tasks of a deep recursion can't fill every
+    worker while the tasks they wait for sit in the queue.
+    """
+    items = list(items)
+    futures = [pool.submit(fn, item) for item in items]
+    return [fn(item) if future.cancel() else future.result() for item, future in zip(items, futures)]
+
 
-@memoize_to_file(cache_file="cache.json")
 def summarize(
     text: str,
     token_quantities: SummarizationParameters,
-    division_point: str,
-    model_name: str
+    division_point: Union[str, Sequence[str]],
+    model_name: str,
+    pool: Optional[ThreadPoolExecutor] = None,
 ) -> str:
+    """
+    Summarize a text to the target size, recursively. Sibling sections are summarized on `pool`, which every level
+    of the recursion shares (a pool of MAX_CONCURRENT_REQUESTS threads if not given).
+    """
     # Shorten text for our console logging
     text_to_print = re.sub(r' +\|\n\|\t', ' ', text).replace("\n", "")
-    print(f"\nSummarizing {len(enc.encode(text))}-token text: {text_to_print[:60]}{'...' if len(text_to_print) > 60 else ''}")
+    text_tokens = count_tokens(text, model_name)
+    print(f"\nSummarizing {text_tokens}-token text: {text_to_print[:60]}{'...' if len(text_to_print) > 60 else ''}")
 
-    if len(enc.encode(text)) <= token_quantities.target_summary_size:
+    if text_tokens <= token_quantities.target_summary_size:
         # If the text is already short enough, just return it
         return text
-    elif len(enc.encode(text)) <= token_quantities.summary_input_size:
-        summary = gpt_summarize(text, token_quantities.target_summary_size)
-        print(f"Summarized {len(enc.encode(text))}-token text into {len(enc.encode(summary))}-token summary: {summary[:250]}{'...' if len(summary) > 250 else ''}")
+    elif text_tokens <= token_quantities.summary_input_size:
+        summary = gpt_summarize(text, token_quantities.target_summary_size, model_name)
+        print(f"Summarized {text_tokens}-token text into {count_tokens(summary, model_name)}-token summary: {summary[:250]}{'...' if len(summary) > 250 else ''}")
         return summary
     else:
         # The text is too long, split it into sections and summarize each section
-        split_input = split_text_into_sections(text, token_quantities.summary_input_size, division_point, model_name)
-
-        summaries = [summarize(x, token_quantities, division_point, model_name) for x in split_input]
+        # The sections are generated lazily, so the first ones are already being summarized while the rest of the
+        # text is still being split.
+        split_input = iter_text_sections(text, token_quantities.summary_input_size, division_point, model_name)
+
+        # Map phase: summarize the sibling sections concurrently, keeping the summaries in input order.
+        with contextlib.ExitStack() as stack:
+            if pool is None:
+                pool = stack.enter_context(ContextThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS))
+            summaries = map_on_pool(
+                pool, lambda x: summarize(x, token_quantities, division_point, model_name, pool), split_input
+            )
+            return summarize("\n\n".join(summaries), token_quantities, division_point, model_name, pool)
 
-        return summarize("\n\n".join(summaries), token_quantities, division_point, model_name)
 
+def summarize_for_targets(
+    text: str,
+    target_summary_sizes: Sequence[int],
+    model_context_size: int,
+    division_point: Union[str, Sequence[str]],
+    model_name: str
+) -> Dict[int, str]:
+    """
+    Summarize the same text at several target sizes. The text is tokenized and split once, at the smallest input
+    size any of the targets allows, and that shared set of leaf sections is summarized for every target. Only the
+    summarization calls and the reduce steps above the leaves are done per target.
+    """
+    token_quantities = {
+        target_summary_size: summarization_token_parameters(target_summary_size, model_context_size)
+        for target_summary_size in target_summary_sizes
+    }
+    leaf_input_size = min(quantities.summary_input_size for quantities in token_quantities.values())
+
+    if count_tokens(text, model_name) <= leaf_input_size:
+        # No splitting needed, every target is a single call.
+        sections = [text]
+    else:
+        sections = split_text_into_sections(text, leaf_input_size, division_point, model_name)
+    print(f"Split text into {len(sections)} shared sections for target sizes {list(token_quantities)}")
+
+    with ContextThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+        # Fan out the leaf summaries of every target at once, so the pool stays full across the whole sweep.
+        leaf_summaries = {
+            target_summary_size: [
+                pool.submit(summarize, section, quantities, division_point, model_name, pool) for section in sections
+            ]
+            for target_summary_size, quantities in token_quantities.items()
+        }
+        # Each target then reduces its own leaf summaries. When there was only one section, its summary is final.
+        # The reduce tasks are queued behind every leaf task, so they never hold a worker a leaf is waiting for.
+        def reduce_target(target_summary_size: int) -> str:
+            summaries = [future.result() for future in leaf_summaries[target_summary_size]]
+            if len(summaries) == 1:
+                return summaries[0]
+            return summarize("\n\n".join(summaries), token_quantities[target_summary_size], division_point, model_name,
+                             pool)
+
+        reduced = {target_summary_size: pool.submit(reduce_target, target_summary_size) for target_summary_size in leaf_summaries}
+        return {target_summary_size: future.result() for target_summary_size, future in reduced.items()}
+
+
+class SummaryReducer:
+    """
+    Reduces the section summaries of a streamed text, in order, to one summary for a single target size without
+    holding on to all of them. Consecutive summaries are grouped until the next one would overflow a request, then
+    the group is summarized in the background and its summary joins the level above, and so on up. Only one partial
+    group per level is kept, so memory grows with the logarithm of the text's length rather than the length itself.
+    """
 
+    def __init__(self, token_quantities: SummarizationParameters, division_point: Union[str, Sequence[str]],
+                 model_name: str, pool: ThreadPoolExecutor):
+        self.token_quantities = token_quantities
+        self.division_point = division_point
+        self.model_name = model_name
+        self.pool = pool
+        # Per level: the summaries waiting to be grouped, their token count, and the summaries of groups from the
+        # level below that are still being written.
+        self.groups: List[List[str]] = []
+        self.group_tokens: List[int] = []
+        self.pending: List[Deque[Future]] = []
+
+    def add(self, summary: str) -> None:
+        """
+        Add the summary of the next section of the text.
+        """
+        self._fold(summary, 0)
+        # Pick up the group summaries that are already done, without waiting for the others.
+        for level in range(1, len(self.pending)):
+            queue = self.pending[level]
+            while queue and queue[0].done():
+                self._fold(queue.popleft().result(), level)
+
+    def result(self) -> str:
+        """
+        Wait for the summaries still being written and return the summary of the whole text.
+        """
+        level = 0
+        while level < len(self.groups):
+            queue = self.pending[level]
+            while queue:
+                self._fold(queue.popleft().result(), level)
+            if level + 1 == len(self.groups):
+                break
+            # Levels above are still open, so what is left here goes up to them.
+            if len(self.groups[level]) > 1:
+                self._reduce(level)
+            elif self.groups[level]:
+                self._fold(self.groups[level].pop(), level + 1)
+            level += 1
+
+        if not self.groups or not self.groups[-1]:
+            return ""
+        top = self.groups[-1]
+        if len(top) == 1:
+            return top[0]
+        return summarize("\n\n".join(top), self.token_quantities, self.division_point, self.model_name, self.pool)
+
+    def _level(self, level: int) -> None:
+        while len(self.groups) <= level:
+            self.groups.append([])
+            self.group_tokens.append(0)
+            self.pending.append(deque())
+
+    def _fold(self, summary: str, level: int) -> None:
+        self._level(level)
+        tokens = count_tokens(summary, self.model_name)
+        if self.groups[level] and self.group_tokens[level] + tokens > self.token_quantities.summary_input_size:
+            self._reduce(level)
+        self.groups[level].append(summary)
+        self.group_tokens[level] += tokens
+
+    def _reduce(self, level: int) -> None:
+        text = "\n\n".join(self.groups[level])
+        self.groups[level], self.group_tokens[level] = [], 0
+        self._level(level + 1)
+        self.pending[level + 1].append(
+            self.pool.submit(summarize, text, self.token_quantities, self.division_point, self.model_name, self.pool)
+        )
 
 
-@memoize_to_file(cache_file="cache.json")
+def summarize_stream_for_targets(
+    blocks: Iterable[str],
+    target_summary_sizes: Sequence[int],
+    model_context_size: int,
+    division_point: Union[str, Sequence[str]],
+    model_name: str,
+    pool: Optional[ThreadPoolExecutor] = None,
+) -> Dict[int, str]:
+    """
+    summarize_for_targets for a text that arrives in blocks, such as a large file read a piece at a time (see
+    ingest.py). Sections are cut from the stream as it is read and summarized right away, at most STREAM_LOOKAHEAD
+    ahead of the oldest unfinished one, and their summaries are reduced as they arrive (see SummaryReducer), so memory
+    use stays about the same however long the text is. Requests run on `pool` if given (which should be a
+    ContextThreadPoolExecutor for the usage meters and labels of the caller to see them, see common.usage), else on a
+    pool of MAX_CONCURRENT_REQUESTS threads.
+    """
+    token_quantities = {
+        target_summary_size: summarization_token_parameters(target_summary_size, model_context_size)
+        for target_summary_size in target_summary_sizes
+    }
+    leaf_input_size = min(quantities.summary_input_size for quantities in token_quantities.values())
+    sections = iter_stream_sections(blocks, leaf_input_size, division_point, model_name)
+
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(ContextThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS))
+        reducers = {
+            target_summary_size: SummaryReducer(quantities, division_point, model_name, pool)
+            for target_summary_size, quantities in token_quantities.items()
+        }
+        in_flight: Deque[Dict[int, Future]] = deque()
+
+        def deliver_oldest() -> None:
+            for target_summary_size, future in in_flight.popleft().items():
+                reducers[target_summary_size].add(future.result())
+
+        for section in sections:
+            in_flight.append({
+                target_summary_size: pool.submit(summarize, section, quantities, division_point, model_name, pool)
+                for target_summary_size, quantities in token_quantities.items()
+            })
+            if len(in_flight) > STREAM_LOOKAHEAD:
+                deliver_oldest()
+        while in_flight:
+            deliver_oldest()
+        return {target_summary_size: reducer.result() for target_summary_size, reducer in reducers.items()}
+
+
+
+
+@memoize_to_file(cache_file="cache.sqlite3")
 def synthesize_summaries(summaries: List[str], model: str) -> str:
     """
     Use a more powerful GPT model to synthesize the summaries into a single summary.
@@ -133,83 +316,12 @@ The summaries are as follows: {summaries_joined}
     assert num_tokens_from_messages(messages, model=model_name) <= 8192
     print(messages)
 
-    result = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-    )
+    result = openai_client().chat_completion(messages, model, call_site="summarizer.synthesize")
     return result.choices[0].message.to_dict()["content"]
 
 
 
 
 model_name = "gpt-3.5-turbo"
-enc = tiktoken.encoding_for_model(model_name)
-
-
-# Great Gatsby
-# response = requests.get("https://www.gutenberg.org/cache/epub/64317/pg64317.txt")
-
-# PETER PAN
-response = requests.get("https://www.gutenberg.org/files/16/16-0.txt")
-
-# Metamorphosis
-# response = requests.get("https://www.gutenberg.org/files/5200/5200-0.txt")
-
-assert response.status_code == 200
-book_complete_text = response.text
-
-# We replace the carriage return character. Because why do these exist in the first place.
-book_complete_text = book_complete_text.replace("\r", "")
-
-# We remove Project Gutenberg's header and footer
-# Project Gutenberg's header is always the same, so we can just remove it:
-split = re.split(r"\*\*\* .+ \*\*\*", book_complete_text)
-
-print("Divided into parts of length:", [len(s) for s in split])
-
-# We select the middle of the split, which is the actual book
-book = split[1]
-
-print(f"Text contains {len(enc.encode(book))} tokens")
-MAX_ATTEMPTS = 3
-
-num_tokens = len(enc.encode(book))
-cost_per_token = 0.002 / 1000
-print(f"As of Q1 2023, the approximate price of this summary will somewhere be on the order of: ${num_tokens * cost_per_token:.2f}")
-
-division_point = "."
-
-# summary = summarize(
-#     book,
-#     summarization_token_parameters(target_summary_size=1000, model_context_size=4097),
-#     division_point,
-#     model_name
-# ).replace("[[[", "").replace("]]]", "")
-
-# print(summary)
-
-
-
-
-summaries: Dict[int, str] = {}
-target_summary_sizes = [500, 750, 1000]
-for target_summary_size in target_summary_sizes:
-    actual_tokens = 0
-    summaries[target_summary_size] = (
-        summarize(
-            book,
-            summarization_token_parameters(target_summary_size=target_summary_size, model_context_size=4097),
-            division_point,
-            model_name,
-        )
-        .replace("[[[", "")
-        .replace("]]]", "")
-        
-    )
-print(summaries)
-
-
-print(synthesize_summaries(list(summaries.values()), "gpt-4"))
-
-
-
+# Ranked by preference: split between paragraphs when possible, then between sentences, then between words.
+DIVISION_POINTS = ("\n\n", ".", " ")
@@ -1,106 +1,184 @@
+import contextvars
 import hashlib
 import json
 import os
-from typing import Dict, List, Tuple
+import re
+import sys
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+from bisect import bisect_right
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
 
-import openai
-import tiktoken
 from dotenv import load_dotenv
 
-load_dotenv(".env")
-
-openai.api_key = os.environ["OPENAI_API_KEY"]
-
-
-# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages, model):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301")
-    elif model == "gpt-4":
-        return num_tokens_from_messages(messages, model="gpt-4-0314")
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4-0314":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
-
-
-def take_tokens(
+# Make the shared modules in <repository_home>/common importable when running from this directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.cache import PersistentCache
+from common.tokens import count_tokens, get_encoding, num_tokens_from_messages
+from common.tracing import span
+
+_MISSING = object()
+
+# Characters of streamed text split at once by iter_stream_sections.
+STREAM_BUFFER_CHARS = 1 << 20
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor that runs each task in a copy of the context it was submitted from, so context variables
+    (like the usage meter and labels of the current document, see common.usage) follow the work onto the pool.
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def openai_client():
+    """
+    The shared API client layer (common.client), imported and given the API key on first use. Importing openai takes
+    a few hundred milliseconds, which code that only splits text or reads cached summaries shouldn't pay for.
+    """
+    load_dotenv(".env")
+    import openai
+    from common import client
+    if not openai.api_key:
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+    return client
+
+
+def iter_text_sections(
     text: str,
     max_token_quantity: int,
-    division_point: str,
+    division_points: Union[str, Sequence[str]],
     model: str,
-) -> Tuple[str, str]:
+) -> Iterator[str]:
     """
     @param text: The text to split
-    @param max_token_quantity: The maximum number of tokens to take from the text
-    @param division_point: A string on which to divide.
-    If the division point does not appear in the text, then splitting a word is acceptable
+    @param max_token_quantity: The maximum number of tokens in each section
+    @param division_points: A string, or a list of strings ranked by preference, on which to divide.
+    If none of the division points appear in a section, then splitting a word is acceptable
     for this implementation.
-    @return: A tuple containing the first part of the text (a best-effort chunk of fewer than max_token_quantity tokens)
-        and the remainder of the text.
-    Split a piece text into two parts, such that the first part contains at most `max_token_quantity` tokens. Divide along
-    division_point[0] unless the string can't be subdivided. If it can't be subdivided, try division_point[1], and so on.
-    """
-
-    # Our initial token count is the number of tokens used by our base prompt, encoded as messages.
-    enc = tiktoken.encoding_for_model(model)
-    current_token_count = num_tokens_from_messages("", model=model)
-    sections = text.split(division_point)
-    non_empty_sections = [section for section in sections if section.strip() != ""]
-
-    for i, section in enumerate(non_empty_sections):
-        if current_token_count + len(enc.encode(section)) >= max_token_quantity:
-            # Entering this loop means the incoming section brings us past max_token_quantity.
-
-            if i == 0:
-                # If i == 0, then we're in the special case where there exists no division-point-separated
-                # section of token length less than max_token_quantity.
-
-                # Thus, we return the first `max_token_quantity` tokens as a chunk, even if it ends on an
-                # awkward split.
-                max_token_chunk = enc.decode(enc.encode(text)[:max_token_quantity])
-                remainder = text[len(max_token_chunk) :]
-                return max_token_chunk, remainder
-            else:
-                # Otherwise, return the accumulated text as a chunk.
-                emit = division_point.join(sections[: i - 1])
-                remainder = division_point.join(sections[i - 1 :])
-                return emit, remainder
+    @return: A generator yielding the sections in order, so the first section can be processed before the rest
+        of the text has been split.
+    Divide along division_points[0] unless a section can't be subdivided that way. If it can't, try
+    division_points[1], and so on. The text is encoded once and the section boundaries are found by walking the
+    token offsets, so splitting takes linear time in the length of the text.
+    """
+    data = text.encode("utf-8")
+    for start, cut in section_spans(data, max_token_quantity, division_points, model):
+        section = data[start:cut].decode("utf-8")
+        if section.strip():
+            yield section
+
+
+def section_spans(
+    data: bytes,
+    max_token_quantity: int,
+    division_points: Union[str, Sequence[str]],
+    model: str,
+) -> Iterator[Tuple[int, int]]:
+    """
+    The byte ranges of the sections of UTF-8 encoded text, as chosen by iter_text_sections. Together they cover the
+    whole text, including sections that are only whitespace.
+    """
+    if isinstance(division_points, str):
+        division_points = [division_points]
+
+    enc = get_encoding(model)
+    # Leave room for the tokens that prime the reply, like the original per-section accounting did.
+    budget = max(1, max_token_quantity - num_tokens_from_messages([], model=model))
+
+    # Work on the UTF-8 bytes so token boundaries can be located exactly. offsets[i] is the byte offset at which
+    # token i starts, and offsets[-1] is the end of the text.
+    with span("chunk.tokenize", bytes=len(data)):
+        tokens = enc.encode(data.decode("utf-8"))
+        offsets = list(accumulate((len(token_bytes) for token_bytes in enc.decode_tokens_bytes(tokens)), initial=0))
+
+    # Byte offsets just past every occurrence of each division point, in ascending order.
+    with span("chunk.division_points", bytes=len(data)):
+        cut_points = [
+            [match.end() for match in re.finditer(re.escape(point.encode("utf-8")), data)]
+            for point in division_points
+            if point
+        ]
+
+    start_token, start_byte = 0, 0
+    while start_byte < len(data):
+        end_token = min(start_token + budget, len(tokens))
+        limit = offsets[end_token]
+
+        if limit >= len(data):
+            cut = len(data)
         else:
-            current_token_count += len(enc.encode(section))
-            current_token_count += len(enc.encode(division_point))
+            cut = None
+            for cuts in cut_points:
+                i = bisect_right(cuts, limit) - 1
+                if i >= 0 and cuts[i] > start_byte:
+                    cut = cuts[i]
+                    break
+            if cut is None:
+                # There is no division point within the budget, so take `budget` tokens even if that ends on an
+                # awkward split. Step back to a character boundary so the section decodes cleanly.
+                cut = limit
+                while cut > start_byte and data[cut] & 0xC0 == 0x80:
+                    cut -= 1
+                if cut == start_byte:
+                    cut = limit + 1
+                    while cut < len(data) and data[cut] & 0xC0 == 0x80:
+                        cut += 1
+
+        yield start_byte, cut
 
-    return text, ""
+        start_byte = cut
+        # Continue from the last token boundary at or before the cut, so the next section's budget is never
+        # overestimated when a division point falls inside a token.
+        start_token = max(start_token + 1, bisect_right(offsets, cut) - 1)
 
 
-def split_text_into_sections(text: str, max_token_quantity: int, division_point: str, model: str) -> List[str]:
+def iter_stream_sections(
+    blocks: Iterable[str],
+    max_token_quantity: int,
+    division_points: Union[str, Sequence[str]],
+    model: str,
+    buffer_chars: int = STREAM_BUFFER_CHARS,
+) -> Iterator[str]:
+    """
+    iter_text_sections for text that arrives in blocks, such as a large file read a piece at a time. The text is split
+    about buffer_chars at a time, and the last section of each buffer is carried over to the next, since the text that
+    follows may belong to it. Memory use depends on buffer_chars, not on the length of the text.
+    """
+    pending = ""
+    for block in blocks:
+        pending += block
+        if len(pending) < buffer_chars:
+            continue
+        data = pending.encode("utf-8")
+        spans = section_spans(data, max_token_quantity, division_points, model)
+        last = next(spans)
+        for next_span in spans:
+            section = data[last[0]:last[1]].decode("utf-8")
+            if section.strip():
+                yield section
+            last = next_span
+        pending = data[last[0]:].decode("utf-8")
+    yield from iter_text_sections(pending, max_token_quantity, division_points, model)
+
+
+def split_text_into_sections(
+    text: str, max_token_quantity: int, division_points: Union[str, Sequence[str]], model: str
+) -> List[str]:
     # Divide the text into sections of at most `max_token_quantity` tokens. Strive to split along division_points[0],
     # but if that can't be done, then fall back to a lower precedence division point.
-    sections = []
-    while text:
-        section, text = take_tokens(text, max_token_quantity, division_point, model)
-        sections.append(section)
-    return sections
+    return list(iter_text_sections(text, max_token_quantity, division_points, model))
+
+
+# Bump this whenever summarization_prompt_messages changes, so summaries produced by the old prompt are not reused.
+SUMMARIZATION_PROMPT_VERSION = 1
 
 
 def summarization_prompt_messages(text: str, target_summary_size: int) -> List[Dict]:
@@ -122,40 +200,94 @@ Strive to make your summary as detailed as possible while remaining under a {tar
     ]
 
 
-def memoize_to_file(cache_file="cache.json"):
+def normalize_chunk(text: str) -> str:
     """
-    Memoization decorator that caches the output of a method in a JSON file.
+    Canonical form of a chunk for cache keys: Unicode NFC, with runs of whitespace collapsed to a single space.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def summary_cache_key(text: str, target_summary_size: int, model: str = "gpt-3.5-turbo") -> str:
+    """
+    Content-addressed cache key for summarizing one chunk. It depends only on the chunk's normalized content and
+    what is sent along with it (model, prompt version and the target size rendered into the prompt), so a chunk
+    keeps its key when the rest of the book is edited or the chunk boundaries around it move.
+    """
+    payload = json.dumps([SUMMARIZATION_PROMPT_VERSION, model, target_summary_size, normalize_chunk(text)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def repr_cache_key(*args) -> str:
+    return hashlib.sha256(repr(tuple(args)).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate)"
+
+
+def memoize_to_file(cache_file="cache.sqlite3", legacy_cache_file="cache.json", max_entries=None, max_age=None,
+                    key_func=repr_cache_key):
+    """
+    Memoization decorator that caches the output of a method in a SQLite file (see common.cache.PersistentCache).
+    The file is opened on the first call, and entries from the JSON file used by earlier versions are imported then if
+    the file didn't exist yet. key_func maps the call's positional arguments to a cache key, so it must give them the
+    same defaults as the function; by default it hashes their repr. The decorated function gets a `cache_stats`
+    attribute counting hits and misses.
     """
 
     def memoize(func):
-        # Load the cache from the JSON file
-        if os.path.exists(cache_file):
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-        else:
-            cache = {}
+        cache = PersistentCache(cache_file, max_entries=max_entries, max_age=max_age)
+        stats = CacheStats()
+        opened = []
+        open_lock = threading.Lock()
+
+        def open_cache() -> None:
+            with open_lock:
+                if opened:
+                    return
+                if legacy_cache_file and not os.path.exists(cache_file):
+                    cache.import_json(legacy_cache_file)
+                opened.append(True)
 
         def wrapped(*args):
-            # Compute the hash of the argument
-            arg_hash = hashlib.sha256(repr(tuple(args)).encode("utf-8")).hexdigest()
-            print("ASSESSING HASH OF: ", repr(tuple(args[1:])), hash(str(args[0])))
+            if not opened:
+                open_cache()
+            with span("cache.key", function=func.__name__):
+                arg_hash = key_func(*args)
             # Check if the result is already cached
-            if arg_hash in cache:
-                print(f"Cached result found for {arg_hash}. Returning it.")
-                return cache[arg_hash]
-            else:
-                print("CACHE NOT FOUND")
+            with span("cache.get", function=func.__name__):
+                result = cache.get(arg_hash, _MISSING)
+            stats.record(hit=result is not _MISSING)
+            if result is not _MISSING:
+                return result
 
             # Compute the result and cache it
             result = func(*args)
-            cache[arg_hash] = result
-
-            # Write the cache to the JSON file
-            with open(cache_file, "w") as f:
-                json.dump(cache, f)
+            with span("cache.set", function=func.__name__):
+                cache.set(arg_hash, result)
 
             return result
 
+        wrapped.cache = cache
+        wrapped.cache_stats = stats
         return wrapped
 
     return memoize